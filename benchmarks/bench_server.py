@@ -0,0 +1,161 @@
+# Copyright © 2025 Illustar0.
+# All rights reserved.
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import toml
+
+import report
+import synthetic
+
+ONEMONITOR_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, "onemonitor"
+)
+APIKEY = "bench"
+
+# legacy 复现改造前的行为：每个请求新建连接，回滚日志模式
+PROFILES = {
+    "legacy": {
+        "poolSize": 0,
+        "journalMode": "DELETE",
+        "synchronous": "FULL",
+        "mmapSize": 0,
+        "cacheSize": -2000,
+        "cachedStatements": 128,
+    },
+    "tuned": {},
+    "group": {"groupCommit": True},
+    # 每次提交都 fsync 时组提交的收益最明显
+    "full": {"synchronous": "FULL"},
+    "group-full": {"synchronous": "FULL", "groupCommit": True},
+}
+
+
+async def drive(client, requests, concurrency, make_request):
+    pending = iter(range(requests))
+    latencies = []
+
+    async def runner():
+        for i in pending:
+            start = time.perf_counter()
+            response = await make_request(client, i)
+            latencies.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.text
+
+    start = time.perf_counter()
+    await asyncio.gather(*(runner() for _ in range(concurrency)))
+    return report.summarize(latencies, time.perf_counter() - start)
+
+
+async def bench(args):
+    import server
+
+    server.init_db()
+    conn = server.connect()
+    end = 1700000000
+    room_ids = synthetic.generate(conn, args.rooms, args.readings, end=end)
+    conn.close()
+    headers = {"Authorization": APIKEY}
+    transport = httpx.ASGITransport(app=server.app)
+
+    def room(i):
+        return room_ids[i % len(room_ids)]
+
+    scenarios = {
+        "info": lambda client, i: client.get("/rooms"),
+        "latest": lambda client, i: client.get(
+            f"/rooms/{room(i)}", params={"filter": "latest"}
+        ),
+        "ranged": lambda client, i: client.get(
+            f"/rooms/{room(i)}", params={"from": end - 86400, "to": end}
+        ),
+        "all": lambda client, i: client.get(f"/rooms/{room(i)}"),
+        "add": lambda client, i: client.post(
+            f"/rooms/{room(i)}",
+            json={"timestamp": end + i, "electricity": 50.0},
+        ),
+    }
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench", headers=headers
+    ) as client:
+        return {
+            name: await drive(client, args.requests, args.concurrency, make_request)
+            for name, make_request in scenarios.items()
+        }
+
+
+def run_profile(profile, args):
+    with tempfile.TemporaryDirectory() as workdir:
+        with open(os.path.join(workdir, "server.toml"), "w") as file:
+            toml.dump(
+                {
+                    "setting": {
+                        "listenAddr": "127.0.0.1",
+                        "listenPort": 8000,
+                        "apiKey": APIKEY,
+                    },
+                    "database": PROFILES[profile],
+                },
+                file,
+            )
+        output = subprocess.run(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--child",
+                "--rooms",
+                str(args.rooms),
+                "--readings",
+                str(args.readings),
+                "--requests",
+                str(args.requests),
+                "--concurrency",
+                str(args.concurrency),
+            ],
+            cwd=workdir,
+            check=True,
+            stdout=subprocess.PIPE,
+            text=True,
+        ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark server.py endpoints on a synthetic database"
+    )
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--readings", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--profile",
+        action="append",
+        choices=list(PROFILES),
+        help="只运行这些配置，可重复传入，缺省时全部运行",
+    )
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    report.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.child:
+        sys.path.insert(0, ONEMONITOR_DIR)
+        print(json.dumps(asyncio.run(bench(args))))
+        return
+
+    results = {}
+    for profile in args.profile or PROFILES:
+        for scenario, result in run_profile(profile, args).items():
+            results[f"{profile}/{scenario}"] = result
+    report.finish(results, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+# Copyright © 2025 Illustar0.
+# All rights reserved.
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+import toml
+
+import report
+import synthetic
+
+ONEMONITOR_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, "onemonitor"
+)
+APIKEY = "bench"
+
+
+# 替代 ZZUPy：不访问校园网，按 --latency 模拟 eCard 接口耗时
+def fake_zzupy(latency):
+    class ECard:
+        def get_remaining_power(self, room_id):
+            time.sleep(latency)
+            return 100.0
+
+    class FakeZZUPy:
+        def __init__(self, usercode, password):
+            self._client = httpx.Client()
+            self.eCard = ECard()
+
+        def login(self):
+            self._client.cookies.set("userToken", "bench", ".zzu.edu.cn", "/")
+
+    return FakeZZUPy
+
+
+def start_server(port):
+    import server
+    import uvicorn
+
+    server.init_db()
+    instance = uvicorn.Server(
+        uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    threading.Thread(target=instance.run, daemon=True).start()
+    while not instance.started:
+        time.sleep(0.05)
+    return instance
+
+
+def bench(args):
+    server_instance = start_server(args.port)
+    import worker
+
+    worker.ZZUPy = fake_zzupy(args.latency / 1000)
+    worker.sync_data_with_cloud()
+    room_ids = list(worker.room_id_list)
+    durations = []
+    for _ in range(args.cycles):
+        # 读数时间戳精确到秒，等到下一秒再开始，避免与上一轮重复
+        time.sleep(1 - time.time() % 1)
+        start = time.perf_counter()
+        results = worker.update_electricity(room_ids)
+        durations.append(time.perf_counter() - start)
+        assert len(results) == len(room_ids)
+    server_instance.should_exit = True
+    return {
+        "mean_s": sum(durations) / len(durations),
+        "p50_s": report.percentile(durations, 0.5),
+        "max_s": max(durations),
+        "rooms_per_s": len(room_ids) * len(durations) / sum(durations),
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_rooms(rooms, args):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        with open(os.path.join(workdir, "server.toml"), "w") as file:
+            toml.dump(
+                {
+                    "setting": {
+                        "listenAddr": "127.0.0.1",
+                        "listenPort": port,
+                        "apiKey": APIKEY,
+                    },
+                    "database": {},
+                },
+                file,
+            )
+        with open(os.path.join(workdir, "worker.toml"), "w") as file:
+            toml.dump(
+                {
+                    "accounts": {"usercode": "bench", "password": "bench"},
+                    "setting": {
+                        "interval": 1800,
+                        "apiEndpoint": f"http://127.0.0.1:{port}",
+                        "apiKey": APIKEY,
+                        "alarmLine": 10,
+                        "warningLine": 20,
+                        # 不限速，只测 worker 自身与服务端的开销
+                        "requestRate": 1000000,
+                        "requestBurst": 1000000,
+                        "concurrency": args.concurrency,
+                    },
+                    "push": {},
+                    "room": {
+                        f"r{i}": {"id": room_id, "name": room_id, "group": "bench"}
+                        for i, room_id in enumerate(synthetic.room_ids(rooms))
+                    },
+                },
+                file,
+            )
+        # worker 每个房间都会写一行日志，只在子进程失败时输出
+        child = subprocess.run(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--child",
+                "--port",
+                str(port),
+                "--cycles",
+                str(args.cycles),
+                "--latency",
+                str(args.latency),
+            ],
+            cwd=workdir,
+            capture_output=True,
+            text=True,
+        )
+    if child.returncode != 0:
+        sys.stderr.write(child.stderr)
+        raise SystemExit(f"Benchmark with {rooms} rooms failed")
+    return json.loads(child.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark worker.py update cycles against a fake eCard"
+    )
+    parser.add_argument(
+        "--rooms", default="10,100,1000", help="逗号分隔的房间数，逐个测试"
+    )
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument(
+        "--latency", type=float, default=20, help="模拟的 eCard 接口耗时（毫秒）"
+    )
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    report.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.child:
+        sys.path.insert(0, ONEMONITOR_DIR)
+        print(json.dumps(bench(args)))
+        return
+
+    results = {}
+    for rooms in args.rooms.split(","):
+        results[f"rooms={int(rooms)}"] = run_rooms(int(rooms), args)
+    report.finish(results, args)
+
+
+if __name__ == "__main__":
+    main()
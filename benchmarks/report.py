@@ -0,0 +1,72 @@
+# Copyright © 2025 Illustar0.
+# All rights reserved.
+import json
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+# 吞吐量以及 p50/p99 延迟（毫秒）
+def summarize(latencies, elapsed):
+    return {
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def print_table(results):
+    metrics = list(next(iter(results.values())))
+    width = max(len(name) for name in results) + 2
+    print(f"{'':<{width}}" + "".join(f"{metric:>12}" for metric in metrics))
+    for name, result in results.items():
+        print(
+            f"{name:<{width}}"
+            + "".join(f"{result[metric]:>12.2f}" for metric in metrics)
+        )
+
+
+# 以 _ms、_s 结尾的指标越小越好，其余越大越好
+def lower_is_better(metric):
+    return metric.endswith("_ms") or metric.endswith("_s")
+
+
+# 与保存的基线比较，返回超出容差的指标，可用作回归门禁
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    regressions = []
+    for name, result in results.items():
+        for metric, value in result.items():
+            base = baseline.get(name, {}).get(metric)
+            if not base:
+                continue
+            change = (value - base) / base
+            if (change if lower_is_better(metric) else -change) > tolerance:
+                regressions.append(f"{name} {metric}: {base:.2f} -> {value:.2f}")
+    return regressions
+
+
+def add_arguments(parser):
+    parser.add_argument("--save", help="把结果保存为 JSON，作为之后比较的基线")
+    parser.add_argument("--compare", help="与该基线比较，有指标退化时以状态码 1 退出")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="允许的退化比例，默认 20%%"
+    )
+
+
+def finish(results, args):
+    print_table(results)
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            raise SystemExit(1)
@@ -0,0 +1,98 @@
+# Copyright © 2025 Illustar0.
+# All rights reserved.
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import toml
+
+ONEMONITOR_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, "onemonitor"
+)
+
+
+def room_ids(rooms):
+    return [f"1-1--{i}-{i}" for i in range(rooms)]
+
+
+# 每个房间的电量按随机速度下降，低于阈值后充值，相同的 seed 生成相同的数据
+def generate(conn, rooms, readings, step=600, end=None, seed=0):
+    rng = random.Random(seed)
+    end = int(time.time()) // step * step if end is None else end
+    start = end - readings * step
+    ids = room_ids(rooms)
+    conn.executemany(
+        """INSERT OR IGNORE INTO rooms VALUES (?, ?, ?, ?);""",
+        [
+            (room_id, room_id, "room_" + room_id.replace("-", "_"), f"bench-{i % 10}")
+            for i, room_id in enumerate(ids)
+        ],
+    )
+    for room_id in ids:
+        electricity = rng.uniform(50, 200)
+        usage = rng.uniform(0.01, 0.2)
+        rows = []
+        for i in range(readings):
+            electricity -= usage * rng.uniform(0.5, 1.5)
+            if electricity < 5:
+                electricity += rng.choice((50, 100, 200))
+            rows.append((room_id, start + i * step, round(electricity, 2)))
+        conn.executemany("""INSERT OR IGNORE INTO readings VALUES (?, ?, ?);""", rows)
+    conn.commit()
+    return ids
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic electricity.db for benchmarks"
+    )
+    parser.add_argument("--output", default="electricity.db")
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--readings", type=int, default=10000)
+    parser.add_argument("--step", type=int, default=600, help="读数间隔（秒）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        # 在临时目录中以 server.py 的配置建表，保证结构与服务端一致
+        sys.path.insert(0, ONEMONITOR_DIR)
+        import server
+
+        server.init_db()
+        conn = server.connect()
+        start = time.perf_counter()
+        generate(conn, args.rooms, args.readings, args.step, seed=args.seed)
+        conn.close()
+        print(
+            f"Generated {args.rooms} rooms x {args.readings} readings "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
+        return
+
+    with tempfile.TemporaryDirectory() as workdir:
+        with open(os.path.join(workdir, "server.toml"), "w") as file:
+            toml.dump(
+                {
+                    "setting": {
+                        "listenAddr": "127.0.0.1",
+                        "listenPort": 8000,
+                        "apiKey": "bench",
+                    },
+                    "database": {"path": os.path.abspath(args.output)},
+                },
+                file,
+            )
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child"] + sys.argv[1:],
+            cwd=workdir,
+            check=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,168 @@
 # Copyright © 2025 Illustar0.
 # All rights reserved.
+import argparse
+import asyncio
+import csv
+import hashlib
+import io
 import json
 import os
+import queue
 import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from enum import Enum
-from typing import List, Any, Dict, Union
-from fastapi import FastAPI, Depends, Request, Security
+from typing import List, Any, Dict, Union, Optional, Tuple, Callable, Iterator
+from fastapi import FastAPI, Request, Security, Query, Header
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.security import APIKeyHeader
 from pydantic import BaseModel, Field
+from loguru import logger
 import uvicorn
 import toml
 
+import metrics
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 
 config = toml.load("server.toml")
 addr = config["setting"]["listenAddr"]
 port = config["setting"]["listenPort"]
 apikey = config["setting"]["apiKey"]
 api_key_header = APIKeyHeader(name="Authorization", auto_error=False)
+# 每个 /stream 订阅者最多积压的事件数
+stream_queue_size = config["setting"].get("streamQueueSize", 100)
+# 无事件时发送心跳的间隔（秒）
+stream_keepalive = config["setting"].get("streamKeepalive", 15)
+
+db_config = config.get("database", {})
+db_path = db_config.get("path", "electricity.db")
+pool_size = db_config.get("poolSize", 4)
+journal_mode = db_config.get("journalMode", "WAL")
+synchronous = db_config.get("synchronous", "NORMAL")
+mmap_size = db_config.get("mmapSize", 268435456)
+cache_size = db_config.get("cacheSize", -65536)
+busy_timeout = db_config.get("busyTimeout", 5000)
+cached_statements = db_config.get("cachedStatements", 256)
+db_workers = db_config.get("workers", 4)
+# 组提交：写入先进入队列，由单个写线程攒够 groupCommitSize 条读数或等待 groupCommitDelay 毫秒后一次提交
+group_commit = db_config.get("groupCommit", False)
+group_commit_size = db_config.get("groupCommitSize", 1000)
+group_commit_delay = db_config.get("groupCommitDelay", 5)
+# 数据保留策略，单位为天，0 表示永久保留
+retention_config = config.get("retention", {})
+retention_days = {
+    "readings": retention_config.get("rawDays", 0),
+    "readings_hourly": retention_config.get("hourlyDays", 0),
+    "readings_daily": retention_config.get("dailyDays", 0),
+}
+retention_interval = retention_config.get("interval", 3600)
+retention_batch_size = retention_config.get("batchSize", 5000)
+retention_batch_pause = retention_config.get("batchPause", 0.05)
+vacuum_pages = retention_config.get("vacuumPages", 1000)
+# 指标：/metrics 始终可用，enabled 为 true 时才记录请求与 SQLite 耗时，关闭时热路径上没有额外开销
+metrics_config = config.get("metrics", {})
+metrics_enabled = metrics_config.get("enabled", False)
+# 统计每个房间的读数行数需要扫描整张表，结果按此间隔（秒）缓存
+room_rows_interval = metrics_config.get("roomRowsInterval", 300)
+if journal_mode.upper() not in ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL"):
+    raise ValueError(f"Unknown journalMode: {journal_mode}")
+if synchronous.upper() not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    raise ValueError(f"Unknown synchronous: {synchronous}")
+
+# 空闲连接池，LIFO 可以让最近用过的连接（缓存最热）优先被复用。
+# 注意 maxsize 为 0 表示不限大小，poolSize 为 0 时由 pooled_connection 直接关闭连接
+db_pool = queue.LifoQueue(maxsize=pool_size)
+db_executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix="db")
+
+registry = metrics.Registry(metrics_enabled)
+request_latency = registry.histogram(
+    "onemonitor_http_request_duration_seconds",
+    "HTTP request latency by route, streaming responses until the last chunk",
+    ("method", "route", "status"),
+)
+db_query_latency = registry.histogram(
+    "onemonitor_sqlite_query_duration_seconds",
+    "Time spent in a data layer function on a database thread",
+    ("function",),
+)
+db_commit_latency = registry.histogram(
+    "onemonitor_sqlite_commit_duration_seconds", "SQLite commit latency"
+)
+
 
+# 启用指标时使用，记录每次提交的耗时，组提交与数据保留的连接也包含在内
+class TimedConnection(sqlite3.Connection):
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            db_commit_latency.observe(time.perf_counter() - start)
 
-def get_db():
-    conn = sqlite3.connect("electricity.db", check_same_thread=False)
+
+def connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        db_path,
+        check_same_thread=False,
+        timeout=busy_timeout / 1000,
+        cached_statements=cached_statements,
+        factory=TimedConnection if metrics_enabled else sqlite3.Connection,
+    )
+    # 必须在切换日志模式之前设置，只对新建的数据库生效，已有数据库需执行一次 python server.py compact --vacuum
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+    conn.execute(f"PRAGMA journal_mode = {journal_mode};")
+    conn.execute(f"PRAGMA synchronous = {synchronous};")
+    conn.execute(f"PRAGMA mmap_size = {int(mmap_size)};")
+    conn.execute(f"PRAGMA cache_size = {int(cache_size)};")
+    conn.execute("PRAGMA foreign_keys = ON;")
+    return conn
+
+
+@contextmanager
+def pooled_connection():
+    try:
+        conn = db_pool.get_nowait()
+    except queue.Empty:
+        conn = connect()
     try:
         yield conn
     finally:
-        conn.close()
+        if conn.in_transaction:
+            conn.rollback()
+        if pool_size <= 0:
+            conn.close()
+        else:
+            try:
+                db_pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+
+def run_with_connection(func: Callable, args: tuple):
+    with pooled_connection() as conn:
+        if not metrics_enabled:
+            return func(conn, *args)
+        start = time.perf_counter()
+        try:
+            return func(conn, *args)
+        finally:
+            db_query_latency.observe(time.perf_counter() - start, func.__name__)
+
+
+# 所有 SQLite 调用都交给专用线程池，避免阻塞事件循环
+async def run_db(func: Callable, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, run_with_connection, func, args)
 
 
 class AuthKeyException(Exception):
@@ -39,6 +175,19 @@ class StatusEnum(str, Enum):
     fail = "fail"
 
 
+class ExportFormatEnum(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+    parquet = "parquet"
+
+
+class AggEnum(str, Enum):
+    avg = "avg"
+    min = "min"
+    max = "max"
+    last = "last"
+
+
 class BaseResponseModel(BaseModel):
     status: StatusEnum = Field(..., description="响应状态，'success'/'error'/'fail'")
     msg: Any = Field(..., description="响应消息，通常为空或包含错误信息")
@@ -60,7 +209,9 @@ class FailResponseModel(BaseResponseModel):
 class RoomData(BaseModel):
     id: str = Field(..., description="房间的 ID")
     name: str = Field(..., description="房间的名称")
-    table_name: str = Field(..., description="房间对应的数据库表名")
+    table_name: str = Field(
+        ..., description="房间对应的旧版数据库表名，仅用于迁移旧数据"
+    )
     room_group: str = Field(..., description="房间的组")
 
 
@@ -69,29 +220,410 @@ class ElectricityData(BaseModel):
     electricity: float = Field(..., description="房间的电量")
 
 
+class RoomElectricityData(BaseModel):
+    room: str = Field(..., description="房间的 ID")
+    data: List[ElectricityData] = Field(
+        ..., description="该房间的电力数据，可包含多个时间戳"
+    )
+
+
+class BatchResultData(BaseModel):
+    room: str = Field(..., description="房间的 ID")
+    status: StatusEnum = Field(..., description="该房间的写入状态")
+    msg: str = Field(..., description="该房间的写入信息，通常为空或包含错误信息")
+
+
+class BatchResponseModel(SuccessResponseModel):
+    data: List[BatchResultData] = Field(
+        ..., description="实际数据，每组对应一个房间的写入结果"
+    )
+
+
 class RoomElectricityResponseModel(SuccessResponseModel):
     data: List[ElectricityData] = Field(
         ..., description="实际数据，每组对应一组电力数据"
     )
 
 
+class ColumnarElectricityData(BaseModel):
+    timestamps: List[int] = Field(..., description="时间戳数组")
+    values: List[float] = Field(..., description="与时间戳一一对应的电量数组")
+
+
+class ColumnarElectricityResponseModel(SuccessResponseModel):
+    data: Dict[str, ColumnarElectricityData] = Field(
+        ..., description="实际数据，键为房间 ID"
+    )
+
+
 class InfoResponseModel(SuccessResponseModel):
     data: List[RoomData] = Field(..., description="实际数据，每组对应一个房间")
 
 
+class SummaryData(BaseModel):
+    room: str = Field(..., description="房间的 ID")
+    name: str = Field(..., description="房间名")
+    room_group: str = Field(..., description="房间所在的分组")
+    timestamp: Optional[int] = Field(..., description="最新读数的时间戳")
+    electricity: Optional[float] = Field(..., description="最新读数")
+    rate_24h: Optional[float] = Field(..., description="最近 24 小时的日均用电")
+    rate_7d: Optional[float] = Field(..., description="最近 7 天的日均用电")
+    recharges_7d: int = Field(..., description="最近 7 天检测到的充值次数")
+    days_to_empty: Optional[float] = Field(
+        ..., description="按 7 天日均用电预计剩余的天数"
+    )
+
+
+class SummaryResponseModel(SuccessResponseModel):
+    data: List[SummaryData] = Field(..., description="每个房间一行")
+
+
+class ImportResultData(BaseModel):
+    inserted: int = Field(..., description="新写入的读数")
+    ignored: int = Field(..., description="时间戳已存在而被忽略的读数")
+    skipped: int = Field(..., description="房间不存在而被跳过的读数")
+
+
+class ImportResponseModel(SuccessResponseModel):
+    data: ImportResultData = Field(..., description="导入结果")
+
+
+class StatsResponseModel(SuccessResponseModel):
+    data: Dict[str, Any] = Field(..., description="运行统计")
+
+
 class ValidationErrorResponseModel(FailResponseModel):
     msg: Dict[str, Union[List[Dict[str, Any]], Any]] = Field(
         ..., description="验证错误的详细信息"
     )
 
 
+# 旧版每个房间一张表时的表名，仅供迁移使用
+def room_table_name(room: str) -> str:
+    return "room_" + room.replace("-", "_")
+
+
+BUCKET_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+AGG_SQL = {
+    AggEnum.avg: "AVG(electricity)",
+    AggEnum.min: "MIN(electricity)",
+    AggEnum.max: "MAX(electricity)",
+    # SQLite 中与 MAX() 同时查询的裸列取自最大值所在的行
+    AggEnum.last: "electricity, MAX(timestamp)",
+}
+# 汇总表及其粒度（秒），粒度大的在前，按 UTC 对齐
+ROLLUPS = {"readings_daily": 86400, "readings_hourly": 3600}
+ROLLUP_AGG_SQL = {
+    AggEnum.avg: "SUM(total) / SUM(count)",
+    AggEnum.min: "MIN(minimum)",
+    AggEnum.max: "MAX(maximum)",
+    AggEnum.last: "last_value, MAX(last_timestamp)",
+}
+
+
+# 将 5m、1h、1d 这类写法转换为秒数
+def parse_bucket(bucket: str) -> int:
+    unit = BUCKET_UNITS.get(bucket[-1:])
+    if unit is None or not bucket[:-1].isdigit() or int(bucket[:-1]) <= 0:
+        raise ValueError("Unknown bucket.")
+    return int(bucket[:-1]) * unit
+
+
+# 聚合粒度和起止时间都能被汇总粒度整除时，汇总表的结果与原始数据完全一致
+def pick_rollup(from_: Optional[int], to: Optional[int], bucket: int) -> Optional[str]:
+    for table, size in ROLLUPS.items():
+        if bucket % size == 0 and all(
+            bound is None or bound % size == 0 for bound in (from_, to)
+        ):
+            return table
+    return None
+
+
+# since 为不含的下界；有聚合时对齐到下一个桶的起点，只返回起点晚于 since 的桶
+def since_to_from(
+    since: Optional[int], from_: Optional[int], bucket: Optional[int]
+) -> Optional[int]:
+    if since is None:
+        return from_
+    lower = since + 1 if bucket is None else (since // bucket + 1) * bucket
+    return lower if from_ is None else max(from_, lower)
+
+
+def build_electricity_query(
+    room: str,
+    from_: Optional[int] = None,
+    to: Optional[int] = None,
+    bucket: Optional[int] = None,
+    agg: AggEnum = AggEnum.avg,
+    latest: bool = False,
+) -> Tuple[str, list]:
+    rollup = pick_rollup(from_, to, bucket) if bucket is not None else None
+    column = "bucket" if rollup is not None else "timestamp"
+    conditions = ["room_id = ?"]
+    params = [room]
+    if from_ is not None:
+        conditions.append(f"{column} >= ?")
+        params.append(from_)
+    if to is not None:
+        conditions.append(f"{column} < ?")
+        params.append(to)
+    where = f"WHERE {' AND '.join(conditions)}"
+    if rollup is not None:
+        return (
+            f"""SELECT bucket / ? * ? AS bucket_start, {ROLLUP_AGG_SQL[agg]} FROM {rollup}
+                {where} GROUP BY bucket_start ORDER BY bucket_start;""",
+            [bucket, bucket] + params,
+        )
+    if latest:
+        return (
+            f"""SELECT timestamp, electricity FROM readings {where}
+                ORDER BY timestamp DESC LIMIT 1;""",
+            params,
+        )
+    if bucket is None:
+        return (
+            f"""SELECT timestamp, electricity FROM readings {where} ORDER BY timestamp;""",
+            params,
+        )
+    return (
+        f"""SELECT timestamp / ? * ? AS bucket, {AGG_SQL[agg]} FROM readings {where}
+            GROUP BY bucket ORDER BY bucket;""",
+        [bucket, bucket] + params,
+    )
+
+
 def check_api_key(api_key: str = Security(api_key_header)) -> str:
     if api_key == apikey:
         return api_key
     raise AuthKeyException
 
 
-app = FastAPI()
+# 热数据缓存：房间列表与每个房间的最新读数，写入成功后同步更新
+class HotCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # 重启后 ETag 全部失效
+        self.boot = f"{time.time_ns():x}"
+        self.rooms: Optional[Dict[str, RoomData]] = None
+        self.rooms_version = 0
+        self.latest: Dict[str, ElectricityData] = {}
+        self.versions: Dict[str, int] = {}
+        self.counter = 0
+        self.summary: Optional[List[SummaryData]] = None
+        self.summary_version: Optional[Tuple[int, int]] = None
+
+    def bump(self, room: str):
+        self.counter += 1
+        self.versions[room] = self.counter
+
+    # version 为查询前的 rooms_version，查询期间房间有变化时丢弃这份快照
+    def load_rooms(self, rooms: List[RoomData], version: int) -> Dict[str, RoomData]:
+        with self.lock:
+            loaded = {room.id: room for room in rooms}
+            if self.rooms is None and self.rooms_version == version:
+                self.rooms = loaded
+            return self.rooms if self.rooms is not None else loaded
+
+    def put_room(self, room: RoomData):
+        with self.lock:
+            if self.rooms is not None:
+                self.rooms[room.id] = room
+            self.rooms_version += 1
+            self.bump(room.id)
+
+    def update_room(self, room: str, room_updated: RoomData):
+        with self.lock:
+            if self.rooms is not None and room in self.rooms:
+                self.rooms[room] = RoomData(
+                    id=room,
+                    name=room_updated.name,
+                    table_name=room_updated.table_name,
+                    room_group=room_updated.room_group,
+                )
+            self.rooms_version += 1
+
+    def delete_room(self, room: str):
+        with self.lock:
+            if self.rooms is not None:
+                self.rooms.pop(room, None)
+            self.latest.pop(room, None)
+            self.rooms_version += 1
+            self.bump(room)
+
+    # 只保留时间戳最新的读数，读库回填与写入并发时也不会被旧数据覆盖。
+    # 写入的可能是补发的历史读数，缓存中还没有该房间时不能用它填充，留给读库回填
+    def record(self, room: str, electricity_list: List[ElectricityData]):
+        with self.lock:
+            newest = max(electricity_list, key=lambda e: e.timestamp, default=None)
+            current = self.latest.get(room)
+            if (
+                newest is not None
+                and current is not None
+                and newest.timestamp >= current.timestamp
+            ):
+                self.latest[room] = newest
+            self.bump(room)
+
+    # 导入的可能是历史数据，缓存中还没有最新值时不能用它填充
+    def record_import(self, room: str, newest: ElectricityData):
+        with self.lock:
+            current = self.latest.get(room)
+            if current is not None and newest.timestamp > current.timestamp:
+                self.latest[room] = newest
+            self.bump(room)
+
+    def room_version(self, room: str) -> int:
+        with self.lock:
+            return self.versions.get(room, 0)
+
+    # version 为查询前的 room_version，查询期间该房间有写入时丢弃这次读库的结果
+    def fill_latest(self, room: str, electricity: ElectricityData, version: int):
+        with self.lock:
+            if self.versions.get(room, 0) != version:
+                return
+            current = self.latest.get(room)
+            if current is None or electricity.timestamp > current.timestamp:
+                self.latest[room] = electricity
+
+    # 任何写入或房间变化都会让汇总失效
+    def summary_key(self) -> Tuple[int, int]:
+        with self.lock:
+            return self.counter, self.rooms_version
+
+    def get_summary(self, key: Tuple[int, int]) -> Optional[List[SummaryData]]:
+        with self.lock:
+            return self.summary if self.summary_version == key else None
+
+    def put_summary(self, key: Tuple[int, int], summary: List[SummaryData]):
+        with self.lock:
+            self.summary = summary
+            self.summary_version = key
+
+    def summary_etag(self, key: Tuple[int, int]) -> str:
+        return f'"{self.boot}-s{key[0]}-{key[1]}"'
+
+    # 过期数据被清理后，缓存的最新读数可能已不存在
+    def expire(self, room: str):
+        with self.lock:
+            self.latest.pop(room, None)
+            self.bump(room)
+
+    def rooms_etag(self) -> str:
+        return f'"{self.boot}-{self.rooms_version}"'
+
+    def etag(self, rooms: List[str]) -> str:
+        with self.lock:
+            versions = ",".join(str(self.versions.get(room, 0)) for room in rooms)
+        return f'"{self.boot}-{hashlib.sha1(versions.encode()).hexdigest()[:16]}"'
+
+
+cache = HotCache()
+
+
+async def cached_rooms() -> Dict[str, RoomData]:
+    rooms = cache.rooms
+    if rooms is not None:
+        return rooms
+    version = cache.rooms_version
+    return cache.load_rooms(await run_db(db_rooms), version)
+
+
+def not_modified(etag: str, if_none_match: Optional[str]) -> bool:
+    return if_none_match is not None and etag in (
+        tag.strip() for tag in if_none_match.split(",")
+    )
+
+
+# 实时推送：每个订阅者一个队列，写入成功后按房间过滤分发，只在事件循环中调用
+class Broadcaster:
+    def __init__(self, size: int):
+        self.size = size
+        self.subscribers: Dict[asyncio.Queue, Optional[set]] = {}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def subscribe(self, rooms: Optional[List[str]]) -> asyncio.Queue:
+        self.loop = asyncio.get_running_loop()
+        subscriber = asyncio.Queue(maxsize=self.size)
+        self.subscribers[subscriber] = set(rooms) if rooms else None
+        return subscriber
+
+    def unsubscribe(self, subscriber: asyncio.Queue):
+        self.subscribers.pop(subscriber, None)
+
+    def publish(self, room: str, electricity_list: List[ElectricityData]):
+        message = None
+        for subscriber, rooms in self.subscribers.items():
+            if rooms is not None and room not in rooms:
+                continue
+            if message is None:
+                data = {
+                    "room": room,
+                    "data": [
+                        electricity.model_dump() for electricity in electricity_list
+                    ],
+                }
+                message = f"event: reading\ndata: {json.dumps(data)}\n\n"
+            try:
+                subscriber.put_nowait(message)
+            except asyncio.QueueFull:
+                # 订阅者跟不上时丢弃积压，让它自行重新拉取
+                while not subscriber.empty():
+                    subscriber.get_nowait()
+                subscriber.put_nowait("event: resync\ndata: {}\n\n")
+
+    # 通知所有订阅者结束连接
+    def close(self):
+        for subscriber in self.subscribers:
+            while not subscriber.empty():
+                subscriber.get_nowait()
+            subscriber.put_nowait(None)
+
+
+broadcaster = Broadcaster(stream_queue_size)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    retention.start()
+    yield
+    retention.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+# 按路由模板统计请求耗时，避免房间号等路径参数产生大量标签
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            request_latency.observe(
+                time.perf_counter() - start,
+                scope["method"],
+                route.path if route is not None else "unmatched",
+                str(status),
+            )
+
+
+if metrics_enabled:
+    app.add_middleware(MetricsMiddleware)
 
 
 @app.exception_handler(AuthKeyException)
@@ -105,14 +637,723 @@ async def unicorn_exception_handler(request: Request, exc: AuthKeyException):
     )
 
 
-@app.exception_handler(RequestValidationError)
-async def validation_exception_handler(request: Request, exc: RequestValidationError):
-    response = ValidationErrorResponseModel(
-        status=StatusEnum.fail,
-        msg={"detail": exc.errors(), "body": exc.body},
-        data=None,
-    )
-    return JSONResponse(status_code=422, content=json.loads(response.model_dump_json()))
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError):
+    response = ValidationErrorResponseModel(
+        status=StatusEnum.fail,
+        msg={"detail": exc.errors(), "body": exc.body},
+        data=None,
+    )
+    return JSONResponse(status_code=422, content=json.loads(response.model_dump_json()))
+
+
+# 以下为数据层，均在数据库线程池中执行，第一个参数为连接池中的连接
+def db_add(conn: sqlite3.Connection, room: str, electricity: ElectricityData):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            """INSERT INTO readings VALUES (?, ?, ?);""",
+            (room, electricity.timestamp, electricity.electricity),
+        )
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+# 在保存点内写入一个房间的读数，失败时只回滚该房间
+def db_insert_room(
+    cursor: sqlite3.Cursor, room_data: RoomElectricityData, ignore: bool
+) -> BatchResultData:
+    cursor.execute("SAVEPOINT room")
+    try:
+        cursor.executemany(
+            f"""INSERT {'OR IGNORE ' if ignore else ''}INTO readings VALUES (?, ?, ?);""",
+            [
+                (room_data.room, electricity.timestamp, electricity.electricity)
+                for electricity in room_data.data
+            ],
+        )
+        cursor.execute("RELEASE SAVEPOINT room")
+        return BatchResultData(room=room_data.room, status=StatusEnum.success, msg="")
+    except sqlite3.Error as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT room")
+        cursor.execute("RELEASE SAVEPOINT room")
+        return BatchResultData(room=room_data.room, status=StatusEnum.error, msg=str(e))
+
+
+def db_add_batch(
+    conn: sqlite3.Connection, readings: List[RoomElectricityData]
+) -> List[BatchResultData]:
+    cursor = conn.cursor()
+    try:
+        # 所有房间共用一个事务，单个房间失败时只回滚到它自己的保存点
+        cursor.execute("BEGIN")
+        # 按 (room_id, timestamp) 幂等，重放已写入的读数不会报错
+        results = [db_insert_room(cursor, room_data, True) for room_data in readings]
+        conn.commit()
+    finally:
+        cursor.close()
+    return results
+
+
+# 多个请求合并为一个事务，ignore 为 False 时与单条写入一样重复时间戳会报错
+def db_add_group(
+    conn: sqlite3.Connection, requests: List[Tuple[List[RoomElectricityData], bool]]
+) -> List[List[BatchResultData]]:
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN")
+        results = [
+            [db_insert_room(cursor, room_data, ignore) for room_data in readings]
+            for readings, ignore in requests
+        ]
+        conn.commit()
+    finally:
+        cursor.close()
+    return results
+
+
+# 组提交写线程，请求在所属的组提交后才返回
+class GroupWriter:
+    def __init__(self, size: int, delay: float):
+        self.size = size
+        self.delay = delay / 1000
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.groups = 0
+        self.requests = 0
+        self.readings = 0
+        self.last_size = 0
+        self.max_size = 0
+        self.latency_total = 0.0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="group-writer", daemon=True
+                )
+                self.thread.start()
+
+    async def submit(
+        self, readings: List[RoomElectricityData], ignore: bool
+    ) -> List[BatchResultData]:
+        self.start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.put((readings, ignore, loop, future))
+        return await future
+
+    # 先阻塞等待第一个请求，再在 delay 内尽量多收集，直到读数达到 size
+    def collect(self) -> list:
+        group = [self.queue.get()]
+        count = sum(len(room_data.data) for room_data in group[0][0])
+        deadline = time.monotonic() + self.delay
+        while count < self.size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            group.append(item)
+            count += sum(len(room_data.data) for room_data in item[0])
+        return group
+
+    def run(self):
+        while True:
+            group = self.collect()
+            start = time.perf_counter()
+            try:
+                results = run_with_connection(
+                    db_add_group, ([(item[0], item[1]) for item in group],)
+                )
+            except Exception as e:
+                logger.error(f"Group commit failed, details: {e}")
+                for _, _, loop, future in group:
+                    loop.call_soon_threadsafe(set_future, future, None, e)
+                continue
+            latency = time.perf_counter() - start
+            count = sum(
+                len(room_data.data) for readings, *_ in group for room_data in readings
+            )
+            with self.lock:
+                self.groups += 1
+                self.requests += len(group)
+                self.readings += count
+                self.last_size = len(group)
+                self.max_size = max(self.max_size, len(group))
+                self.latency_total += latency
+                self.last_latency = latency
+                self.max_latency = max(self.max_latency, latency)
+            for (_, _, loop, future), result in zip(group, results):
+                loop.call_soon_threadsafe(set_future, future, result, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "groups": self.groups,
+                "requests": self.requests,
+                "readings": self.readings,
+                "pending": self.queue.qsize(),
+                "last_group_size": self.last_size,
+                "avg_group_size": self.requests / self.groups if self.groups else 0,
+                "max_group_size": self.max_size,
+                "last_commit_ms": self.last_latency * 1000,
+                "avg_commit_ms": (
+                    self.latency_total / self.groups * 1000 if self.groups else 0
+                ),
+                "max_commit_ms": self.max_latency * 1000,
+            }
+
+
+# 请求方可能已断开，future 已取消时直接丢弃结果
+def set_future(future: asyncio.Future, result: Any, exception: Optional[Exception]):
+    if future.done():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+
+group_writer = (
+    GroupWriter(group_commit_size, group_commit_delay) if group_commit else None
+)
+
+
+RETENTION_COLUMNS = {
+    "readings": "timestamp",
+    "readings_hourly": "bucket",
+    "readings_daily": "bucket",
+}
+
+
+# 按主键顺序删除一个房间最多 limit 行过期数据，每批一个短事务，不会长时间占用写锁
+def db_delete_expired(
+    conn: sqlite3.Connection, table: str, room: str, cutoff: int, limit: int
+) -> int:
+    column = RETENTION_COLUMNS[table]
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            f"""SELECT {column} FROM {table} WHERE room_id = ? AND {column} < ?
+                ORDER BY {column} LIMIT 1 OFFSET ?;""",
+            (room, cutoff, limit - 1),
+        )
+        row = cursor.fetchone()
+        cursor.execute(
+            f"""DELETE FROM {table} WHERE room_id = ? AND {column} < ?;""",
+            (room, cutoff if row is None else row[0] + 1),
+        )
+        conn.commit()
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+# 归还最多 pages 个空闲页，返回 (归还的页数, 剩余的空闲页数)
+def db_incremental_vacuum(conn: sqlite3.Connection, pages: int) -> Tuple[int, int]:
+    (before,) = conn.execute("PRAGMA page_count;").fetchone()
+    # execute() 每次只步进一次，只会归还一页，executescript 会执行到底
+    conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+    (after,) = conn.execute("PRAGMA page_count;").fetchone()
+    (free,) = conn.execute("PRAGMA freelist_count;").fetchone()
+    return before - after, free
+
+
+# 后台按保留策略分批清理过期数据，再增量回收空闲页
+class Retention:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.runs = 0
+        self.last_run: Optional[int] = None
+        self.last_report: Optional[Dict[str, Any]] = None
+        self.rows = {table: 0 for table in RETENTION_COLUMNS}
+        self.pages = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.stopping.clear()
+                self.thread = threading.Thread(
+                    target=self.run, name="retention", daemon=True
+                )
+                self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            thread.join()
+
+    def run(self):
+        while not self.stopping.wait(retention_interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Retention run failed, details: {e}")
+
+    def delete_expired(self, now: int) -> Dict[str, int]:
+        deleted = {}
+        rooms = [room.id for room in run_with_connection(db_rooms, ())]
+        for table, days in retention_days.items():
+            deleted[table] = 0
+            if days <= 0:
+                continue
+            cutoff = now - int(days * 86400)
+            if table == "readings":
+                # 只删除完整的汇总桶，保证 rebuild-rollups 不会用残缺的原始数据覆盖汇总
+                size = max(ROLLUPS.values())
+                cutoff = cutoff // size * size
+            for room in rooms:
+                room_deleted = 0
+                while not self.stopping.is_set():
+                    count = run_with_connection(
+                        db_delete_expired,
+                        (table, room, cutoff, retention_batch_size),
+                    )
+                    room_deleted += count
+                    if count < retention_batch_size:
+                        break
+                    # 批次之间让出写锁
+                    self.stopping.wait(retention_batch_pause)
+                if room_deleted and table == "readings":
+                    cache.expire(room)
+                deleted[table] += room_deleted
+        return deleted
+
+    def vacuum(self) -> int:
+        reclaimed = 0
+        with pooled_connection() as conn:
+            (auto_vacuum,) = conn.execute("PRAGMA auto_vacuum;").fetchone()
+        if auto_vacuum != 2:
+            return reclaimed
+        while not self.stopping.is_set():
+            pages, free = run_with_connection(db_incremental_vacuum, (vacuum_pages,))
+            reclaimed += pages
+            if free == 0 or pages == 0:
+                break
+            self.stopping.wait(retention_batch_pause)
+        return reclaimed
+
+    def run_once(self) -> Dict[str, Any]:
+        now = int(time.time())
+        start = time.perf_counter()
+        deleted = self.delete_expired(now)
+        pages = self.vacuum()
+        report = {
+            "timestamp": now,
+            "rows_deleted": deleted,
+            "pages_reclaimed": pages,
+            "seconds": time.perf_counter() - start,
+        }
+        with self.lock:
+            self.runs += 1
+            self.last_run = now
+            self.last_report = report
+            for table, count in deleted.items():
+                self.rows[table] += count
+            self.pages += pages
+        logger.info(
+            f"Retention removed {sum(deleted.values())} rows {deleted} and reclaimed {pages} pages"
+        )
+        return report
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "days": retention_days,
+                "runs": self.runs,
+                "rows_deleted": dict(self.rows),
+                "pages_reclaimed": self.pages,
+                "last": self.last_report,
+            }
+
+
+retention = Retention()
+
+
+def db_add_room(conn: sqlite3.Connection, room: RoomData):
+    cursor = conn.cursor()
+    try:
+        # 不能用 REPLACE，它会先删除旧行，级联删掉该房间的全部读数
+        cursor.execute(
+            """INSERT INTO rooms VALUES (?, ?, ?, ?)
+               ON CONFLICT(id) DO UPDATE SET
+               name = excluded.name,
+               table_name = excluded.table_name,
+               room_group = excluded.room_group;""",
+            (room.id, room.name, room.table_name, room.room_group),
+        )
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+# 批量增改房间，全部在一个事务中提交
+def db_upsert_rooms(conn: sqlite3.Connection, rooms: List[RoomData]):
+    cursor = conn.cursor()
+    try:
+        cursor.executemany(
+            """INSERT INTO rooms VALUES (?, ?, ?, ?)
+               ON CONFLICT(id) DO UPDATE SET
+               name = excluded.name,
+               table_name = excluded.table_name,
+               room_group = excluded.room_group;""",
+            [(room.id, room.name, room.table_name, room.room_group) for room in rooms],
+        )
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def db_update_room(conn: sqlite3.Connection, room: str, room_updated: RoomData):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            """UPDATE rooms SET name = ?, table_name = ?, room_group = ? WHERE id = ?;""",
+            (
+                room_updated.name,
+                room_updated.table_name,
+                room_updated.room_group,
+                room,
+            ),
+        )
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+def db_delete_room(conn: sqlite3.Connection, room: str):
+    cursor = conn.cursor()
+    try:
+        # readings 中该房间的数据会被外键级联删除
+        cursor.execute("""DELETE FROM rooms WHERE id = ?;""", (room,))
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+def db_room_electricity(
+    conn: sqlite3.Connection,
+    room: str,
+    latest: bool,
+    from_: Optional[int],
+    to: Optional[int],
+    bucket: Optional[int],
+    agg: AggEnum,
+) -> List[ElectricityData]:
+    cursor = conn.cursor()
+    try:
+        cursor.execute(*build_electricity_query(room, from_, to, bucket, agg, latest))
+        return [
+            ElectricityData(timestamp=row[0], electricity=row[1])
+            for row in cursor.fetchall()
+        ]
+    finally:
+        cursor.close()
+
+
+# 直接由游标结果组装列式数据，不为每行构造 pydantic 模型
+# from_ 为每个房间各自的起始时间戳，增量同步时各房间的进度不同
+def db_readings(
+    conn: sqlite3.Connection,
+    rooms: List[str],
+    from_: Dict[str, Optional[int]],
+    to: Optional[int],
+    bucket: Optional[int],
+    agg: AggEnum,
+) -> Dict[str, Dict[str, list]]:
+    cursor = conn.cursor()
+    try:
+        data = {}
+        for room in rooms:
+            cursor.execute(*build_electricity_query(room, from_[room], to, bucket, agg))
+            rows = cursor.fetchall()
+            data[room] = {
+                "timestamps": [row[0] for row in rows],
+                "values": [row[1] for row in rows],
+            }
+        return data
+    finally:
+        cursor.close()
+
+
+# 以各房间最新读数为基准取最近 7 天，用窗口函数一次算出相邻读数的差值：
+# 下降计为用电，上升计为一次充值，用电量除以这些间隔的总时长得到日均用电
+SUMMARY_SQL = """
+WITH latest AS (
+    SELECT id, name, room_group,
+           (SELECT MAX(timestamp) FROM readings WHERE room_id = rooms.id) AS latest
+    FROM rooms
+),
+recent AS (
+    SELECT readings.room_id, readings.timestamp, readings.electricity, latest.latest,
+           readings.electricity - LAG(readings.electricity) OVER w AS delta,
+           readings.timestamp - LAG(readings.timestamp) OVER w AS elapsed
+    FROM latest JOIN readings
+    ON readings.room_id = latest.id AND readings.timestamp >= latest.latest - 604800
+    WINDOW w AS (PARTITION BY readings.room_id ORDER BY readings.timestamp)
+),
+usage AS (
+    SELECT room_id,
+           MAX(CASE WHEN timestamp = latest THEN electricity END) AS electricity,
+           SUM(CASE WHEN delta < 0 AND timestamp > latest - 86400
+                    THEN -delta ELSE 0 END) AS used_24h,
+           SUM(CASE WHEN timestamp > latest - 86400 THEN elapsed END) AS elapsed_24h,
+           SUM(CASE WHEN delta < 0 THEN -delta ELSE 0 END) AS used_7d,
+           SUM(elapsed) AS elapsed_7d,
+           COUNT(CASE WHEN delta > 0 THEN 1 END) AS recharges_7d
+    FROM recent GROUP BY room_id
+)
+SELECT latest.id, latest.name, latest.room_group, latest.latest, usage.electricity,
+       usage.used_24h, usage.elapsed_24h, usage.used_7d, usage.elapsed_7d,
+       COALESCE(usage.recharges_7d, 0)
+FROM latest LEFT JOIN usage ON usage.room_id = latest.id ORDER BY latest.id;
+"""
+
+
+def daily_rate(used: Optional[float], elapsed: Optional[int]) -> Optional[float]:
+    if not elapsed:
+        return None
+    return used / elapsed * 86400
+
+
+def db_summary(conn: sqlite3.Connection) -> List[SummaryData]:
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SUMMARY_SQL)
+        summary = []
+        for row in cursor.fetchall():
+            rate_7d = daily_rate(row[7], row[8])
+            summary.append(
+                SummaryData(
+                    room=row[0],
+                    name=row[1],
+                    room_group=row[2],
+                    timestamp=row[3],
+                    electricity=row[4],
+                    rate_24h=daily_rate(row[5], row[6]),
+                    rate_7d=rate_7d,
+                    recharges_7d=row[9],
+                    days_to_empty=(
+                        row[4] / rate_7d if row[4] is not None and rate_7d else None
+                    ),
+                )
+            )
+        return summary
+    finally:
+        cursor.close()
+
+
+EXPORT_COLUMNS = ["room", "timestamp", "electricity"]
+EXPORT_MEDIA_TYPES = {
+    ExportFormatEnum.ndjson: "application/x-ndjson",
+    ExportFormatEnum.csv: "text/csv",
+    ExportFormatEnum.parquet: "application/vnd.apache.parquet",
+}
+# 导出和导入每次处理的行数
+TRANSFER_CHUNK_SIZE = 10000
+
+
+# 按主键顺序逐块读取，整个导出是一条语句，WAL 下看到的是同一个快照
+def db_export_chunks(
+    rooms: Optional[List[str]],
+    group: Optional[str],
+    from_: Optional[int],
+    to: Optional[int],
+) -> Iterator[List[tuple]]:
+    conditions = []
+    params = []
+    if rooms:
+        conditions.append(f"room_id IN ({', '.join('?' * len(rooms))})")
+        params.extend(rooms)
+    if group is not None:
+        conditions.append("room_id IN (SELECT id FROM rooms WHERE room_group = ?)")
+        params.append(group)
+    if from_ is not None:
+        conditions.append("timestamp >= ?")
+        params.append(from_)
+    if to is not None:
+        conditions.append("timestamp < ?")
+        params.append(to)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    with pooled_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                f"""SELECT room_id, timestamp, electricity FROM readings {where}
+                    ORDER BY room_id, timestamp;""",
+                params,
+            )
+            while True:
+                rows = cursor.fetchmany(TRANSFER_CHUNK_SIZE)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+
+def encode_ndjson(chunks: Iterator[List[tuple]]) -> Iterator[bytes]:
+    for rows in chunks:
+        yield "".join(
+            json.dumps(dict(zip(EXPORT_COLUMNS, row))) + "\n" for row in rows
+        ).encode()
+
+
+def encode_csv(chunks: Iterator[List[tuple]]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+# 供 ParquetWriter 写入的文件对象，每写完一个行组就把已写出的字节交给响应
+class ChunkSink(io.RawIOBase):
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def encode_parquet(chunks: Iterator[List[tuple]]) -> Iterator[bytes]:
+    schema = pyarrow.schema(
+        [
+            ("room", pyarrow.string()),
+            ("timestamp", pyarrow.int64()),
+            ("electricity", pyarrow.float64()),
+        ]
+    )
+    sink = ChunkSink()
+    with pyarrow.parquet.ParquetWriter(sink, schema) as writer:
+        for rows in chunks:
+            writer.write_table(
+                pyarrow.Table.from_arrays(
+                    [pyarrow.array(column) for column in zip(*rows)], schema=schema
+                )
+            )
+            yield sink.drain()
+    yield sink.drain()
+
+
+EXPORT_ENCODERS = {
+    ExportFormatEnum.ndjson: encode_ndjson,
+    ExportFormatEnum.csv: encode_csv,
+    ExportFormatEnum.parquet: encode_parquet,
+}
+
+
+def db_import_chunk(conn: sqlite3.Connection, rows: List[tuple]) -> int:
+    cursor = conn.cursor()
+    try:
+        cursor.executemany("""INSERT OR IGNORE INTO readings VALUES (?, ?, ?);""", rows)
+        conn.commit()
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+# 逐行解析请求体，不把整个文件读入内存
+async def request_lines(request: Request):
+    pending = b""
+    async for chunk in request.stream():
+        pending += chunk
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line.decode()
+    if pending:
+        yield pending.decode()
+
+
+def parse_row(room: Any, timestamp: Any, electricity: Any) -> tuple:
+    return str(room), int(timestamp), float(electricity)
+
+
+async def import_rows(request: Request, format: ExportFormatEnum):
+    if format == ExportFormatEnum.ndjson:
+        async for line in request_lines(request):
+            if line.strip():
+                row = json.loads(line)
+                yield parse_row(*(row[column] for column in EXPORT_COLUMNS))
+    elif format == ExportFormatEnum.csv:
+        header = None
+        async for line in request_lines(request):
+            if not line.strip():
+                continue
+            values = next(csv.reader([line]))
+            if header is None:
+                header = [values.index(column) for column in EXPORT_COLUMNS]
+                continue
+            yield parse_row(*(values[index] for index in header))
+    else:
+        # Parquet 的元数据在文件末尾，先落盘再按批读取
+        with tempfile.TemporaryFile() as file:
+            async for chunk in request.stream():
+                file.write(chunk)
+            file.seek(0)
+            batches = pyarrow.parquet.ParquetFile(file).iter_batches(
+                batch_size=TRANSFER_CHUNK_SIZE, columns=EXPORT_COLUMNS
+            )
+            while True:
+                batch = await asyncio.to_thread(next, batches, None)
+                if batch is None:
+                    break
+                for row in zip(*(column.to_pylist() for column in batch.columns)):
+                    yield parse_row(*row)
+
+
+def db_rooms(conn: sqlite3.Connection) -> List[RoomData]:
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""SELECT * FROM rooms;""")
+        return [
+            RoomData(id=row[0], name=row[1], table_name=row[2], room_group=row[3])
+            for row in cursor.fetchall()
+        ]
+    finally:
+        cursor.close()
+
+
+def db_room_rows(conn: sqlite3.Connection) -> Dict[str, int]:
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""SELECT room_id, COUNT(*) FROM readings GROUP BY room_id;""")
+        return dict(cursor.fetchall())
+    finally:
+        cursor.close()
 
 
 @app.post(
@@ -126,22 +1367,54 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
 async def add(
     room: str,
     electricity: ElectricityData,
-    conn: sqlite3.Connection = Depends(get_db),
     api_key: str = Security(check_api_key),
 ):
-    cursor = conn.cursor()
     try:
-        cursor.execute(
-            f"""INSERT INTO {"room_" + room.replace("-", "_")} VALUES (?, ?);""",
-            (electricity.timestamp, electricity.electricity),
-        )
-        conn.commit()
+        if group_writer is not None:
+            result = (
+                await group_writer.submit(
+                    [RoomElectricityData(room=room, data=[electricity])], False
+                )
+            )[0]
+            if result.status == StatusEnum.error:
+                raise sqlite3.Error(result.msg)
+        else:
+            await run_db(db_add, room, electricity)
+        cache.record(room, [electricity])
+        broadcaster.publish(room, [electricity])
         response = SuccessResponseModel(status=StatusEnum.success, msg="", data=None)
     except sqlite3.Error as e:
         response = ErrorResponseModel(status=StatusEnum.error, msg=str(e), data=None)
         return JSONResponse(json.loads(response.model_dump_json()), 500)
-    finally:
-        cursor.close()
+    return JSONResponse(json.loads(response.model_dump_json()), 200)
+
+
+@app.post(
+    "/readings",
+    responses={
+        500: {"model": ErrorResponseModel},
+        200: {"model": BatchResponseModel},
+        422: {"model": ValidationErrorResponseModel},
+    },
+)
+async def add_batch(
+    readings: List[RoomElectricityData],
+    api_key: str = Security(check_api_key),
+):
+    try:
+        if group_writer is not None:
+            results = await group_writer.submit(readings, True)
+        else:
+            results = await run_db(db_add_batch, readings)
+        for room_data, result in zip(readings, results):
+            if result.status == StatusEnum.success:
+                cache.record(room_data.room, room_data.data)
+                if room_data.data:
+                    broadcaster.publish(room_data.room, room_data.data)
+        response = BatchResponseModel(status=StatusEnum.success, msg="", data=results)
+    except sqlite3.Error as e:
+        response = ErrorResponseModel(status=StatusEnum.error, msg=str(e), data=None)
+        return JSONResponse(json.loads(response.model_dump_json()), 500)
     return JSONResponse(json.loads(response.model_dump_json()), 200)
 
 
@@ -155,32 +1428,38 @@ async def add(
 )
 async def add_room(
     room: RoomData,
-    conn: sqlite3.Connection = Depends(get_db),
     api_key: str = Security(check_api_key),
 ):
-    cursor = conn.cursor()
     try:
-        cursor.execute(
-            f"""REPLACE INTO rooms VALUES (
-                           '{room.id}',
-                           '{room.name}',
-                           '{room.table_name}',
-                           '{room.room_group}'  
-                           );"""
-        )
-        cursor.execute(
-            f"""CREATE TABLE IF NOT EXISTS {room.table_name}(
-                    timestamp INT PRIMARY KEY NOT NULL,
-                    electricity INT NOT NULL
-                    );"""
-        )
-        conn.commit()
+        await run_db(db_add_room, room)
+        cache.put_room(room)
+        response = SuccessResponseModel(status=StatusEnum.success, msg="", data=None)
+    except sqlite3.Error as e:
+        response = ErrorResponseModel(status=StatusEnum.error, msg=str(e), data=None)
+        return JSONResponse(json.loads(response.model_dump_json()), 500)
+    return JSONResponse(json.loads(response.model_dump_json()), 200)
+
+
+@app.put(
+    "/rooms",
+    responses={
+        500: {"model": ErrorResponseModel},
+        200: {"model": SuccessResponseModel},
+        422: {"model": ValidationErrorResponseModel},
+    },
+)
+async def upsert_rooms(
+    rooms: List[RoomData],
+    api_key: str = Security(check_api_key),
+):
+    try:
+        await run_db(db_upsert_rooms, rooms)
+        for room in rooms:
+            cache.put_room(room)
         response = SuccessResponseModel(status=StatusEnum.success, msg="", data=None)
     except sqlite3.Error as e:
         response = ErrorResponseModel(status=StatusEnum.error, msg=str(e), data=None)
         return JSONResponse(json.loads(response.model_dump_json()), 500)
-    finally:
-        cursor.close()
     return JSONResponse(json.loads(response.model_dump_json()), 200)
 
 
@@ -195,21 +1474,15 @@ async def add_room(
 async def update_room(
     room: str,
     room_updated: RoomData,
-    conn: sqlite3.Connection = Depends(get_db),
     api_key: str = Security(check_api_key),
 ):
-    cursor = conn.cursor()
     try:
-        cursor.execute(
-            f"""UPDATE rooms SET name = '{room_updated.name}', table_name = '{room_updated.table_name}', room_group = '{room_updated.room_group}' WHERE id = '{room}';"""
-        )
-        conn.commit()
+        await run_db(db_update_room, room, room_updated)
+        cache.update_room(room, room_updated)
         response = SuccessResponseModel(status=StatusEnum.success, msg="", data=None)
     except sqlite3.Error as e:
         response = ErrorResponseModel(status=StatusEnum.error, msg=str(e), data=None)
         return JSONResponse(json.loads(response.model_dump_json()), 500)
-    finally:
-        cursor.close()
     return JSONResponse(json.loads(response.model_dump_json()), 200)
 
 
@@ -223,10 +1496,8 @@ async def update_room(
 )
 async def delete_room(
     room: str,
-    conn: sqlite3.Connection = Depends(get_db),
     api_key: str = Security(check_api_key),
 ):
-    cursor = conn.cursor()
     if room == "rooms":
         response = ErrorResponseModel(
             status=StatusEnum.error,
@@ -235,16 +1506,12 @@ async def delete_room(
         )
         return JSONResponse(json.loads(response.model_dump_json()), 500)
     try:
-        room_table_name = "room_" + room.replace("-", "_")
-        cursor.execute(f"""DELETE FROM rooms WHERE id = '{room}';""")
-        cursor.execute(f"""DROP TABLE IF EXISTS {room_table_name};""")
-        conn.commit()
+        await run_db(db_delete_room, room)
+        cache.delete_room(room)
         response = SuccessResponseModel(status=StatusEnum.success, msg="", data=None)
     except sqlite3.Error as e:
         response = ErrorResponseModel(status=StatusEnum.error, msg=str(e), data=None)
         return JSONResponse(json.loads(response.model_dump_json()), 500)
-    finally:
-        cursor.close()
     return JSONResponse(json.loads(response.model_dump_json()), 200)
 
 
@@ -258,40 +1525,55 @@ async def delete_room(
 )
 async def room_electricity(
     room: str,
-    conn: sqlite3.Connection = Depends(get_db),
     api_key: str = Security(check_api_key),
+    if_none_match: Optional[str] = Header(None),
     filter: str = "all",
+    from_: Optional[int] = Query(None, alias="from", description="起始时间戳（含）"),
+    to: Optional[int] = Query(None, description="结束时间戳（不含）"),
+    bucket: Optional[str] = Query(None, description="聚合粒度，如 5m、1h、1d"),
+    agg: AggEnum = Query(AggEnum.avg, description="聚合方式"),
+    since: Optional[int] = Query(
+        None, description="只返回时间戳（或桶起点）晚于该值的数据，用于增量同步"
+    ),
 ):
-    #
-    cursor = conn.cursor()
-
+    if filter not in ("all", "latest"):
+        response = ErrorResponseModel(
+            status=StatusEnum.error, msg="Unknown filter.", data=None
+        )
+        return JSONResponse(json.loads(response.model_dump_json()), 500)
     try:
-        cursor.execute(f"""SELECT table_name FROM rooms WHERE id = '{room}'""")
-        (room_table_name,) = cursor.fetchall()[0]
-    except sqlite3.Error as e:
-        cursor.close()
+        bucket_seconds = (
+            parse_bucket(bucket) if bucket is not None and filter == "all" else None
+        )
+    except ValueError as e:
         response = ErrorResponseModel(status=StatusEnum.error, msg=str(e), data=None)
         return JSONResponse(json.loads(response.model_dump_json()), 500)
+    from_ = since_to_from(since, from_, bucket_seconds)
+    # 先取版本号再查询，查询期间有写入时 ETag 只会偏旧，不会让新数据被 304 掩盖
+    etag = cache.etag([room])
+    if not_modified(etag, if_none_match):
+        return Response(status_code=304, headers={"ETag": etag})
     try:
-        if filter == "all":
-            cursor.execute(f"""SELECT * FROM {room_table_name}""")
-
-        elif filter == "latest":
-            cursor.execute(
-                f"""SELECT * FROM {room_table_name} ORDER BY timestamp DESC LIMIT 1;"""
-            )
+        if room not in await cached_rooms():
+            raise ValueError("Unknown room.")
+        latest = cache.latest.get(room)
+        if filter == "latest" and from_ is None and to is None and latest is not None:
+            data = [latest]
         else:
-            response = ErrorResponseModel(
-                status=StatusEnum.error, msg="Unknown filter.", data=None
+            version = cache.room_version(room)
+            data = await run_db(
+                db_room_electricity,
+                room,
+                filter == "latest",
+                from_,
+                to,
+                bucket_seconds,
+                agg,
             )
-            return JSONResponse(json.loads(response.model_dump_json()), 500)
-        rows = cursor.fetchall()
+            if filter == "latest" and from_ is None and to is None and data:
+                cache.fill_latest(room, data[0], version)
         response = RoomElectricityResponseModel(
-            status=StatusEnum.success,
-            msg="",
-            data=[
-                ElectricityData(timestamp=row[0], electricity=row[1]) for row in rows
-            ],
+            status=StatusEnum.success, msg="", data=data
         )
     except sqlite3.Error as e:
         response = ErrorResponseModel(status=StatusEnum.error, msg=str(e), data=None)
@@ -299,11 +1581,197 @@ async def room_electricity(
     except Exception as e:
         response = ErrorResponseModel(status=StatusEnum.error, msg=str(e), data=None)
         return JSONResponse(json.loads(response.model_dump_json()), 500)
-    finally:
-        cursor.close()
+    return JSONResponse(
+        json.loads(response.model_dump_json()), 200, headers={"ETag": etag}
+    )
+
+
+@app.get(
+    "/readings",
+    responses={
+        500: {"model": ErrorResponseModel},
+        200: {"model": ColumnarElectricityResponseModel},
+        422: {"model": ValidationErrorResponseModel},
+    },
+)
+async def readings(
+    room: List[str] = Query(..., description="房间 ID，可重复传入多个"),
+    api_key: str = Security(check_api_key),
+    if_none_match: Optional[str] = Header(None),
+    from_: Optional[int] = Query(None, alias="from", description="起始时间戳（含）"),
+    to: Optional[int] = Query(None, description="结束时间戳（不含）"),
+    bucket: Optional[str] = Query(None, description="聚合粒度，如 5m、1h、1d"),
+    agg: AggEnum = Query(AggEnum.avg, description="聚合方式"),
+    since: Optional[List[int]] = Query(
+        None,
+        description="只返回时间戳（或桶起点）晚于该值的数据，只传一个时用于所有房间，否则按顺序与 room 一一对应",
+    ),
+):
+    etag = cache.etag(list(dict.fromkeys(room)))
+    if not_modified(etag, if_none_match):
+        return Response(status_code=304, headers={"ETag": etag})
+    try:
+        bucket_seconds = parse_bucket(bucket) if bucket is not None else None
+        if since is None:
+            since = [None]
+        if len(since) == 1:
+            since = since * len(room)
+        if len(since) != len(room):
+            raise ValueError("since must be given once or once per room.")
+        # 重复的房间以第一次出现为准
+        room_since = {}
+        for room_id, room_id_since in zip(room, since):
+            room_since.setdefault(room_id, room_id_since)
+        rooms = list(room_since)
+        missing = set(rooms) - set(await cached_rooms())
+        if missing:
+            raise ValueError(f"Unknown room: {', '.join(sorted(missing))}")
+        lower = {
+            room_id: since_to_from(room_since[room_id], from_, bucket_seconds)
+            for room_id in rooms
+        }
+        data = await run_db(db_readings, rooms, lower, to, bucket_seconds, agg)
+    except sqlite3.Error as e:
+        response = ErrorResponseModel(status=StatusEnum.error, msg=str(e), data=None)
+        return JSONResponse(json.loads(response.model_dump_json()), 500)
+    except ValueError as e:
+        response = ErrorResponseModel(status=StatusEnum.error, msg=str(e), data=None)
+        return JSONResponse(json.loads(response.model_dump_json()), 500)
+    return JSONResponse(
+        {"status": StatusEnum.success.value, "msg": "", "data": data},
+        200,
+        headers={"ETag": etag},
+    )
+
+
+@app.get(
+    "/export",
+    response_class=StreamingResponse,
+    responses={
+        500: {"model": ErrorResponseModel},
+        200: {
+            "content": {media_type: {} for media_type in EXPORT_MEDIA_TYPES.values()}
+        },
+        422: {"model": ValidationErrorResponseModel},
+    },
+)
+async def export(
+    api_key: str = Security(check_api_key),
+    format: ExportFormatEnum = Query(ExportFormatEnum.ndjson, description="导出格式"),
+    room: Optional[List[str]] = Query(
+        None, description="房间 ID，可重复传入多个，缺省时导出全部房间"
+    ),
+    group: Optional[str] = Query(None, description="只导出该分组的房间"),
+    from_: Optional[int] = Query(None, alias="from", description="起始时间戳（含）"),
+    to: Optional[int] = Query(None, description="结束时间戳（不含）"),
+):
+    if format == ExportFormatEnum.parquet and pyarrow is None:
+        response = ErrorResponseModel(
+            status=StatusEnum.error, msg="Parquet export requires pyarrow.", data=None
+        )
+        return JSONResponse(json.loads(response.model_dump_json()), 500)
+    # 同步生成器由 Starlette 放到线程中逐块迭代，不占用数据库线程池
+    return StreamingResponse(
+        EXPORT_ENCODERS[format](db_export_chunks(room, group, from_, to)),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={
+            "Content-Disposition": f'attachment; filename="readings.{format.value}"'
+        },
+    )
+
+
+@app.post(
+    "/import",
+    responses={
+        500: {"model": ErrorResponseModel},
+        200: {"model": ImportResponseModel},
+        422: {"model": ValidationErrorResponseModel},
+    },
+)
+async def import_(
+    request: Request,
+    api_key: str = Security(check_api_key),
+    format: ExportFormatEnum = Query(ExportFormatEnum.ndjson, description="导入格式"),
+):
+    if format == ExportFormatEnum.parquet and pyarrow is None:
+        response = ErrorResponseModel(
+            status=StatusEnum.error, msg="Parquet import requires pyarrow.", data=None
+        )
+        return JSONResponse(json.loads(response.model_dump_json()), 500)
+    result = ImportResultData(inserted=0, ignored=0, skipped=0)
+
+    # 每块单独提交，中途失败时已导入的部分会保留，重新导入时按时间戳去重
+    async def flush(rows: List[tuple]):
+        inserted = await run_db(db_import_chunk, rows)
+        result.inserted += inserted
+        result.ignored += len(rows) - inserted
+        newest = {}
+        for row in rows:
+            if row[0] not in newest or row[1] > newest[row[0]][1]:
+                newest[row[0]] = row
+        for room, timestamp, electricity in newest.values():
+            cache.record_import(
+                room, ElectricityData(timestamp=timestamp, electricity=electricity)
+            )
+
+    try:
+        rooms = await cached_rooms()
+        rows = []
+        async for row in import_rows(request, format):
+            if row[0] not in rooms:
+                result.skipped += 1
+                continue
+            rows.append(row)
+            if len(rows) >= TRANSFER_CHUNK_SIZE:
+                await flush(rows)
+                rows = []
+        if rows:
+            await flush(rows)
+        response = ImportResponseModel(status=StatusEnum.success, msg="", data=result)
+    except Exception as e:
+        response = ErrorResponseModel(
+            status=StatusEnum.error,
+            msg=f"{e} (imported before the error: {result.inserted})",
+            data=None,
+        )
+        return JSONResponse(json.loads(response.model_dump_json()), 500)
     return JSONResponse(json.loads(response.model_dump_json()), 200)
 
 
+@app.get(
+    "/stream",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"text/event-stream": {}}}},
+)
+async def stream(
+    room: Optional[List[str]] = Query(
+        None, description="只订阅这些房间，可重复传入多个，缺省时订阅全部"
+    ),
+    api_key: str = Security(check_api_key),
+):
+    async def events():
+        subscriber = broadcaster.subscribe(room)
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscriber.get(), stream_keepalive)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if message is None:
+                    break
+                yield message
+        finally:
+            broadcaster.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get(
     "/rooms",
     responses={
@@ -313,31 +1781,184 @@ async def room_electricity(
     },
 )
 async def info(
-    conn: sqlite3.Connection = Depends(get_db),
     api_key: str = Security(check_api_key),
+    if_none_match: Optional[str] = Header(None),
 ):
-    cursor = conn.cursor()
+    etag = cache.rooms_etag()
+    if not_modified(etag, if_none_match):
+        return Response(status_code=304, headers={"ETag": etag})
     try:
-        cursor.execute(f"""SELECT * FROM rooms""")
-        rows = cursor.fetchall()
+        data = list((await cached_rooms()).values())
         response = InfoResponseModel(
-            status=StatusEnum(StatusEnum.success),
-            msg="",
-            data=[
-                RoomData(id=row[0], name=row[1], table_name=row[2], room_group=row[3])
-                for row in rows
-            ],
+            status=StatusEnum(StatusEnum.success), msg="", data=data
         )
     except sqlite3.Error as e:
         response = ErrorResponseModel(status=StatusEnum.error, msg=str(e), data=None)
         return JSONResponse(json.loads(response.model_dump_json()), 500)
-    finally:
-        cursor.close()
+    return JSONResponse(
+        json.loads(response.model_dump_json()), 200, headers={"ETag": etag}
+    )
+
+
+@app.get(
+    "/summary",
+    responses={
+        500: {"model": ErrorResponseModel},
+        200: {"model": SummaryResponseModel},
+    },
+)
+async def summary(
+    api_key: str = Security(check_api_key),
+    if_none_match: Optional[str] = Header(None),
+):
+    # 先取版本号再计算，计算期间有写入时下次请求会重新计算
+    key = cache.summary_key()
+    etag = cache.summary_etag(key)
+    if not_modified(etag, if_none_match):
+        return Response(status_code=304, headers={"ETag": etag})
+    try:
+        data = cache.get_summary(key)
+        if data is None:
+            data = await run_db(db_summary)
+            cache.put_summary(key, data)
+        response = SummaryResponseModel(status=StatusEnum.success, msg="", data=data)
+    except sqlite3.Error as e:
+        response = ErrorResponseModel(status=StatusEnum.error, msg=str(e), data=None)
+        return JSONResponse(json.loads(response.model_dump_json()), 500)
+    return JSONResponse(
+        json.loads(response.model_dump_json()), 200, headers={"ETag": etag}
+    )
+
+
+@app.get(
+    "/stats",
+    responses={
+        500: {"model": ErrorResponseModel},
+        200: {"model": StatsResponseModel},
+    },
+)
+async def stats(
+    api_key: str = Security(check_api_key),
+):
+    response = StatsResponseModel(
+        status=StatusEnum.success,
+        msg="",
+        data={
+            "group_commit": (
+                group_writer.stats() if group_writer is not None else None
+            ),
+            "retention": retention.stats(),
+        },
+    )
     return JSONResponse(json.loads(response.model_dump_json()), 200)
 
 
+# 每个房间的读数行数，抓取时按 roomRowsInterval 刷新
+class RoomRows:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.rows: Dict[str, int] = {}
+        self.updated_at: Optional[float] = None
+
+    async def refresh(self):
+        if (
+            self.updated_at is None
+            or time.monotonic() - self.updated_at >= self.interval
+        ):
+            self.rows = await run_db(db_room_rows)
+            self.updated_at = time.monotonic()
+
+
+room_rows = RoomRows(room_rows_interval)
+
+
+def db_file_sizes() -> Dict[Tuple, int]:
+    sizes = {}
+    for file, path in (("db", db_path), ("wal", db_path + "-wal")):
+        if os.path.exists(path):
+            sizes[(file,)] = os.path.getsize(path)
+    return sizes
+
+
+def group_commit_stat(key: str) -> Callable:
+    return lambda: {(): group_writer.stats()[key]} if group_writer is not None else {}
+
+
+registry.gauge(
+    "onemonitor_db_size_bytes", "Size of the database files", ("file",), db_file_sizes
+)
+registry.gauge(
+    "onemonitor_room_rows",
+    "Raw readings stored per room",
+    ("room",),
+    lambda: {(room,): rows for room, rows in room_rows.rows.items()},
+)
+registry.gauge(
+    "onemonitor_stream_subscribers",
+    "Open /stream connections",
+    collect=lambda: {(): len(broadcaster.subscribers)},
+)
+registry.counter(
+    "onemonitor_group_commit_groups_total",
+    "Group commit transactions",
+    collect=group_commit_stat("groups"),
+)
+registry.counter(
+    "onemonitor_group_commit_requests_total",
+    "Write requests handled by group commit",
+    collect=group_commit_stat("requests"),
+)
+registry.counter(
+    "onemonitor_group_commit_readings_total",
+    "Readings written by group commit",
+    collect=group_commit_stat("readings"),
+)
+registry.gauge(
+    "onemonitor_group_commit_pending",
+    "Write requests waiting for the group commit thread",
+    collect=group_commit_stat("pending"),
+)
+registry.counter(
+    "onemonitor_retention_runs_total",
+    "Completed retention runs",
+    collect=lambda: {(): retention.stats()["runs"]},
+)
+registry.counter(
+    "onemonitor_retention_rows_deleted_total",
+    "Rows deleted by the retention policy",
+    ("table",),
+    lambda: {
+        (table,): rows for table, rows in retention.stats()["rows_deleted"].items()
+    },
+)
+registry.counter(
+    "onemonitor_retention_pages_reclaimed_total",
+    "Pages returned to the file system by incremental vacuum",
+    collect=lambda: {(): retention.stats()["pages_reclaimed"]},
+)
+
+
+@app.get(
+    "/metrics",
+    response_class=Response,
+    responses={
+        500: {"model": ErrorResponseModel},
+        200: {"content": {metrics.CONTENT_TYPE: {}}},
+    },
+)
+async def prometheus_metrics(
+    api_key: str = Security(check_api_key),
+):
+    try:
+        await room_rows.refresh()
+    except sqlite3.Error as e:
+        response = ErrorResponseModel(status=StatusEnum.error, msg=str(e), data=None)
+        return JSONResponse(json.loads(response.model_dump_json()), 500)
+    return Response(registry.render(), media_type=metrics.CONTENT_TYPE)
+
+
 def init_db():
-    conn = sqlite3.connect("electricity.db", check_same_thread=False)
+    conn = connect()
     cursor = conn.cursor()
     cursor.execute(
         f"""CREATE TABLE IF NOT EXISTS rooms(
@@ -347,12 +1968,221 @@ def init_db():
                     room_group TEXT NOT NULL
                     );"""
     )
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS readings(
+                    room_id TEXT NOT NULL REFERENCES rooms(id) ON DELETE CASCADE,
+                    timestamp INT NOT NULL,
+                    electricity REAL NOT NULL,
+                    PRIMARY KEY (room_id, timestamp)
+                    ) WITHOUT ROWID;"""
+    )
+    for table, size in ROLLUPS.items():
+        cursor.execute(
+            f"""CREATE TABLE IF NOT EXISTS {table}(
+                    room_id TEXT NOT NULL REFERENCES rooms(id) ON DELETE CASCADE,
+                    bucket INT NOT NULL,
+                    total REAL NOT NULL,
+                    count INT NOT NULL,
+                    minimum REAL NOT NULL,
+                    maximum REAL NOT NULL,
+                    first_timestamp INT NOT NULL,
+                    first_value REAL NOT NULL,
+                    last_timestamp INT NOT NULL,
+                    last_value REAL NOT NULL,
+                    PRIMARY KEY (room_id, bucket)
+                    ) WITHOUT ROWID;"""
+        )
+        # 触发器只对真正插入的行生效，所有写入路径都会同步更新汇总表
+        cursor.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {table}_insert AFTER INSERT ON readings
+                BEGIN
+                    INSERT INTO {table} VALUES (
+                        NEW.room_id, NEW.timestamp / {size} * {size},
+                        NEW.electricity, 1, NEW.electricity, NEW.electricity,
+                        NEW.timestamp, NEW.electricity, NEW.timestamp, NEW.electricity
+                    )
+                    ON CONFLICT(room_id, bucket) DO UPDATE SET
+                        total = total + excluded.total,
+                        count = count + 1,
+                        minimum = MIN(minimum, excluded.minimum),
+                        maximum = MAX(maximum, excluded.maximum),
+                        first_value = CASE WHEN excluded.first_timestamp < first_timestamp
+                            THEN excluded.first_value ELSE first_value END,
+                        first_timestamp = MIN(first_timestamp, excluded.first_timestamp),
+                        last_value = CASE WHEN excluded.last_timestamp > last_timestamp
+                            THEN excluded.last_value ELSE last_value END,
+                        last_timestamp = MAX(last_timestamp, excluded.last_timestamp);
+                END;"""
+        )
     conn.commit()
     cursor.close()
     conn.close()
 
 
+# 由原始数据重新计算汇总表。只覆盖原始数据仍然存在的时间段，已清理的历史汇总会保留
+def rebuild_rollups():
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""SELECT id FROM rooms;""")
+        room_ids = [row[0] for row in cursor.fetchall()]
+        for table, size in ROLLUPS.items():
+            for room_id in room_ids:
+                # 起点早于最早原始读数的桶，其原始数据可能已被清理，只在汇总缺失时补上
+                cursor.execute(
+                    """SELECT MIN(timestamp) FROM readings WHERE room_id = ?;""",
+                    (room_id,),
+                )
+                (oldest,) = cursor.fetchone()
+                if oldest is None:
+                    continue
+                for verb, condition in (
+                    ("REPLACE", "bucket >= ?"),
+                    ("INSERT OR IGNORE", "bucket < ?"),
+                ):
+                    cursor.execute(
+                        f"""{verb} INTO {table}
+                        SELECT room_id, bucket, SUM(electricity), COUNT(*),
+                               MIN(electricity), MAX(electricity),
+                               MIN(timestamp), MIN(first_value),
+                               MAX(timestamp), MIN(last_value)
+                        FROM (
+                            SELECT room_id, timestamp, electricity,
+                                   timestamp / {size} * {size} AS bucket,
+                                   FIRST_VALUE(electricity) OVER w AS first_value,
+                                   LAST_VALUE(electricity) OVER w AS last_value
+                            FROM readings WHERE room_id = ?
+                            WINDOW w AS (
+                                PARTITION BY timestamp / {size} ORDER BY timestamp
+                                ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING
+                            )
+                        )
+                        GROUP BY bucket HAVING {condition};""",
+                        (room_id, oldest),
+                    )
+                # 每个房间单独提交，避免长时间持有写锁
+                conn.commit()
+            logger.info(f"Rebuilt {table} for {len(room_ids)} rooms")
+    finally:
+        cursor.close()
+        conn.close()
+
+
+# table_name 可由 API 任意设置，只认旧版命名的 room_ 表，并排除当前的表，避免 migrate --drop 删掉它们
+def legacy_tables(conn: sqlite3.Connection) -> List[Tuple[str, str]]:
+    current_tables = ["rooms", "readings", *ROLLUPS]
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            f"""SELECT rooms.id, rooms.table_name FROM rooms
+               JOIN sqlite_master ON sqlite_master.name = rooms.table_name
+               WHERE sqlite_master.type = 'table'
+                 AND rooms.table_name LIKE 'room\\_%' ESCAPE '\\'
+                 AND rooms.table_name NOT IN ({', '.join('?' * len(current_tables))});""",
+            current_tables,
+        )
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+# 将旧版每个房间一张的表分批导入 readings，每批单独提交，迁移期间服务可以继续运行
+def migrate(chunk_size: int = 10000, drop: bool = False):
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        for room_id, table_name in legacy_tables(conn):
+            copied = 0
+            last_timestamp = None
+            while True:
+                if last_timestamp is None:
+                    cursor.execute(
+                        f"""SELECT timestamp, electricity FROM {table_name}
+                            ORDER BY timestamp LIMIT ?;""",
+                        (chunk_size,),
+                    )
+                else:
+                    cursor.execute(
+                        f"""SELECT timestamp, electricity FROM {table_name}
+                            WHERE timestamp > ? ORDER BY timestamp LIMIT ?;""",
+                        (last_timestamp, chunk_size),
+                    )
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                cursor.executemany(
+                    """INSERT OR IGNORE INTO readings VALUES (?, ?, ?);""",
+                    [(room_id, row[0], row[1]) for row in rows],
+                )
+                conn.commit()
+                copied += len(rows)
+                last_timestamp = rows[-1][0]
+            if drop:
+                cursor.execute(f"""DROP TABLE {table_name};""")
+                conn.commit()
+            logger.info(f"Migrated {copied} rows of room id = {room_id}")
+    finally:
+        cursor.close()
+        conn.close()
+
+
+# /stream 的长连接不会自行关闭，收到退出信号时先结束它们，uvicorn 才能正常退出
+class Server(uvicorn.Server):
+    def handle_exit(self, sig, frame):
+        if broadcaster.loop is not None:
+            broadcaster.loop.call_soon_threadsafe(broadcaster.close)
+        super().handle_exit(sig, frame)
+
+
 if __name__ == "__main__":
-    if os.path.exists("electricity.db") is not True:
-        init_db()
-    uvicorn.run(app, host=addr, port=port)
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    migrate_parser = subparsers.add_parser(
+        "migrate", help="将旧版每个房间一张的表迁移到 readings 表"
+    )
+    migrate_parser.add_argument("--chunk-size", type=int, default=10000)
+    migrate_parser.add_argument(
+        "--drop", action="store_true", help="迁移完成后删除旧表"
+    )
+    subparsers.add_parser("rebuild-rollups", help="由原始数据重新计算小时和日汇总表")
+    compact_parser = subparsers.add_parser(
+        "compact", help="立即按保留策略清理过期数据并回收空间"
+    )
+    compact_parser.add_argument(
+        "--vacuum",
+        action="store_true",
+        help="先完整 VACUUM 一次，把已有数据库切换为增量回收模式",
+    )
+    args = parser.parse_args()
+    init_db()
+    if args.command == "migrate":
+        migrate(args.chunk_size, args.drop)
+    elif args.command == "rebuild-rollups":
+        rebuild_rollups()
+    elif args.command == "compact":
+        if args.vacuum:
+            conn = connect()
+            conn.execute("VACUUM;")
+            conn.close()
+        print(json.dumps(retention.run_once(), indent=2))
+    else:
+        conn = connect()
+        if legacy_tables(conn):
+            logger.warning(
+                "Found per-room tables from an older version, run 'python server.py migrate' to import them"
+            )
+        (rollups_missing,) = conn.execute(
+            """SELECT EXISTS(SELECT 1 FROM readings)
+                      AND NOT EXISTS(SELECT 1 FROM readings_hourly);"""
+        ).fetchone()
+        if rollups_missing:
+            logger.warning(
+                "Rollup tables are empty, run 'python server.py rebuild-rollups' to fill them"
+            )
+        (auto_vacuum,) = conn.execute("PRAGMA auto_vacuum;").fetchone()
+        if auto_vacuum != 2:
+            logger.warning(
+                "Incremental vacuum is off for this database, run 'python server.py compact --vacuum' once to enable it"
+            )
+        conn.close()
+        Server(uvicorn.Config(app, host=addr, port=port)).run()
@@ -2,17 +2,27 @@
 # All rights reserved.
 import sys
 import json
+import time
+import threading
 import toml
 import httpx
+import numpy as np
 import pandas as pd
+import plotly.graph_objects as go
 import streamlit as st
 from loguru import logger
+from collections import OrderedDict
 
 config = toml.load("web.toml")
 page_title = config["setting"]["pageTitle"]
 interval = config["setting"]["refreshInterval"]
 api_endpoint = config["setting"]["apiEndpoint"]
 apikey = config["setting"]["apiKey"]
+frame_cache_size = config["setting"].get("frameCacheSize", 256)
+# 图表宽度（像素），每个像素最多画 2 个点，由所有勾选的房间平分
+chart_width = config["setting"].get("chartWidth", 1200)
+# 图表重新渲染的间隔（秒），只有收到推送的房间才会重新拉取
+live_interval = config["setting"].get("liveInterval", 5)
 
 logger.configure(
     handlers=[
@@ -42,32 +52,294 @@ def get_hitokoto():
         return None
 
 
+# 所有会话共用一个保持连接的客户端
+@st.cache_resource
+def get_client():
+    return httpx.Client(
+        base_url=api_endpoint,
+        headers={"Authorization": f"{apikey}"},
+        timeout=30,
+    )
+
+
 @st.cache_data(ttl=interval)
 def fetch_rooms():
     try:
-        response = httpx.get(
-            f"{api_endpoint}/rooms", headers={"Authorization": f"{apikey}"}
-        )
+        response = get_client().get("/rooms")
+        # 只缓存解析后的房间列表，重跑页面时不再重复解析
+        rooms = json.loads(response.text)["data"]
         logger.info(f"Rooms data refreshed successfully")
-        return response
+        return rooms
     except Exception as e:
         logger.error(f"An error occurred while refreshing ROOMS data, details: {e}")
         return None
 
 
+# 各房间的余额、日均用电和预计可用天数，由服务端一次算出
 @st.cache_data(ttl=interval)
-def fetch_room_electricity(id):
+def fetch_summary():
     try:
-        response = httpx.get(
-            f"{api_endpoint}/rooms/{id}",
-            headers={"Authorization": f"{apikey}"},
-        )
-        return response
+        response = get_client().get("/summary")
+        return {row["room"]: row for row in json.loads(response.text)["data"]}
     except Exception as e:
-        logger.error(
-            f"An error occurred while trying to get data for the room id = {id}, details: {e}"
+        logger.error(f"An error occurred while getting the summary, details: {e}")
+        return {}
+
+
+def summary_help(row):
+    if row is None or row["electricity"] is None:
+        return None
+    text = f"剩余：{row['electricity']:.2f}"
+    if row["rate_7d"] is not None:
+        text += f"，近 7 天日均：{row['rate_7d']:.2f}"
+    if row["days_to_empty"] is not None:
+        text += f"，预计 {row['days_to_empty']:.1f} 天后用完"
+    return text
+
+
+# 每个房间已取回的按小时聚合数据，跨会话共享，刷新时只追加新的部分
+class RoomFrames:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames = {}
+        # 上一次批量请求的房间集合及其 ETag，房间集合相同时才能用于条件请求
+        self.last_etag = (None, None)
+        self.fetched_at = {}
+        # 数据有变化时递增，最后一个小时的值可能变化而时间戳不变
+        self.versions = {}
+
+    def get(self, room_id):
+        with self.lock:
+            return self.frames.get(room_id), self.versions.get(room_id, 0)
+
+    # 不传房间时全部标记为过期
+    def invalidate(self, room_id=None):
+        with self.lock:
+            if room_id is None:
+                self.fetched_at.clear()
+            else:
+                self.fetched_at.pop(room_id, None)
+
+    def stale(self, room_id):
+        with self.lock:
+            return time.time() - self.fetched_at.get(room_id, 0) >= interval
+
+    # 所有过期房间合并为一次 /readings 请求，每个房间从自己已有的最后一个小时开始增量拉取
+    def refresh(self, room_ids):
+        key = tuple(sorted(room_ids))
+        with self.lock:
+            frames = {room_id: self.frames.get(room_id) for room_id in room_ids}
+            last_key, etag = self.last_etag
+        since = []
+        for room_id in room_ids:
+            df = frames[room_id]
+            # 最后一个小时可能还在增长，从它开始重新取；没有数据时从头取
+            since.append(
+                int(df.index[-1].timestamp()) - 1
+                if df is not None and not df.empty
+                else -1
+            )
+        headers = {}
+        if last_key == key and etag:
+            headers["If-None-Match"] = etag
+        response = get_client().get(
+            "/readings",
+            params={"room": list(room_ids), "since": since, "bucket": "1h"},
+            headers=headers,
+        )
+        if response.status_code == 304:
+            with self.lock:
+                for room_id in room_ids:
+                    self.fetched_at[room_id] = time.time()
+            return
+        response_json = json.loads(response.text)
+        if response.status_code != 200 or response_json["status"] != "success":
+            raise ValueError(response_json["msg"])
+        with self.lock:
+            for room_id in room_ids:
+                self.merge(room_id, frames[room_id], response_json["data"][room_id])
+            self.last_etag = (key, response.headers.get("ETag"))
+
+    def merge(self, room_id, df, room_data):
+        new = pd.DataFrame(
+            {"electricity": room_data["values"]},
+            index=pd.to_datetime(
+                pd.Index(room_data["timestamps"], name="timestamp"), unit="s"
+            ),
         )
+        if df is not None and not new.empty:
+            new = pd.concat([df[df.index < new.index[0]], new])
+        elif df is not None:
+            new = df
+        if new is not df:
+            self.versions[room_id] = self.versions.get(room_id, 0) + 1
+        self.frames[room_id] = new
+        self.fetched_at[room_id] = time.time()
+
+
+@st.cache_resource
+def get_room_frames():
+    return RoomFrames()
+
+
+# 订阅服务端的 /stream，有新读数时把对应房间标记为过期，下次渲染时只增量拉取它
+def consume_stream(room_frames):
+    backoff = 1
+    while True:
+        try:
+            with get_client().stream(
+                "GET", "/stream", timeout=httpx.Timeout(30, read=60)
+            ) as response:
+                response.raise_for_status()
+                logger.info("Subscribed to the server stream")
+                backoff = 1
+                # 断线期间可能错过了推送
+                room_frames.invalidate()
+                event = None
+                for line in response.iter_lines():
+                    if line.startswith("event:"):
+                        event = line[6:].strip()
+                    elif line.startswith("data:") and event == "reading":
+                        room_frames.invalidate(json.loads(line[5:])["room"])
+                    elif line.startswith("data:") and event == "resync":
+                        room_frames.invalidate()
+                    elif not line:
+                        event = None
+        except Exception as e:
+            logger.warning(f"The server stream was interrupted, details: {e}")
+        time.sleep(backoff)
+        backoff = min(backoff * 2, 60)
+
+
+# 每个 Streamlit 进程只建立一条推送连接，所有标签页共用
+@st.cache_resource
+def start_stream_consumer():
+    thread = threading.Thread(
+        target=consume_stream, args=(get_room_frames(),), daemon=True
+    )
+    thread.start()
+    return thread
+
+
+# 有界的 LRU 缓存，保存重采样后的 DataFrame 和图表，超过容量时淘汰最久未用的
+class FrameCache:
+    def __init__(self, size):
+        self.lock = threading.Lock()
+        self.size = size
+        self.frames = OrderedDict()
+
+    def get(self, key, build):
+        with self.lock:
+            if key in self.frames:
+                self.frames.move_to_end(key)
+                return self.frames[key]
+        frame = build()
+        with self.lock:
+            self.frames[key] = frame
+            self.frames.move_to_end(key)
+            while len(self.frames) > self.size:
+                self.frames.popitem(last=False)
+        return frame
+
+
+@st.cache_resource
+def get_frame_cache():
+    return FrameCache(frame_cache_size)
+
+
+def resample_hourly(df):
+    # 服务端已按小时聚合，这里只需补齐缺失的小时
+    return df.resample("h").mean().ffill()
+
+
+# Largest-Triangle-Three-Buckets 降采样，返回保留的下标，能保住峰值和骤降
+def lttb(x, y, threshold):
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    every = (n - 2) / (threshold - 2)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        # 下一个桶的平均点作为三角形的第三个顶点
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        areas = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(areas.argmax())
+        selected[i + 1] = a
+    selected[-1] = n - 1
+    return selected
+
+
+def downsample(df, points):
+    x = df.index.asi8.astype(np.float64)
+    y = df["electricity"].to_numpy(dtype=np.float64)
+    return df.iloc[lttb(x, y, points)]
+
+
+# WebGL 绘制，点数多时浏览器也不卡
+def build_figure(frames):
+    figure = go.Figure(
+        [
+            go.Scattergl(x=df.index, y=df["electricity"], mode="lines", name=name)
+            for name, df in frames
+        ]
+    )
+    figure.update_layout(
+        xaxis_title="timestamp",
+        yaxis_title="electricity",
+        legend_title_text="room",
+        margin={"l": 0, "r": 0, "t": 30, "b": 0},
+    )
+    return figure
+
+
+# 按 (房间, 名称, 最后时间戳, 版本) 复用重采样、降采样结果和图表，数据未变时重跑页面不做任何计算
+def chart_figure(rooms_frames, names):
+    frame_cache = get_frame_cache()
+    points = max(chart_width * 2 // len(names), 50)
+    keys = []
+    frames = []
+    for name in names:
+        df, version = rooms_frames[name2id[name]]
+        if df is None or df.empty:
+            continue
+        key = (name2id[name], name, int(df.index[-1].timestamp()), version)
+        df_hourly = frame_cache.get(key, lambda df=df: resample_hourly(df))
+        keys.append(key)
+        frames.append(
+            (
+                name,
+                frame_cache.get(
+                    key + (points,),
+                    lambda df_hourly=df_hourly: downsample(df_hourly, points),
+                ),
+            )
+        )
+    if not frames:
         return None
+    return frame_cache.get((tuple(keys), points), lambda: build_figure(frames))
+
+
+# 并发刷新过期的房间，返回各房间的数据
+def fetch_rooms_electricity(ids):
+    room_frames = get_room_frames()
+    stale_ids = [room_id for room_id in ids if room_frames.stale(room_id)]
+    if stale_ids:
+        try:
+            room_frames.refresh(stale_ids)
+        except Exception as e:
+            logger.error(
+                f"An error occurred while trying to get data for the room id = {', '.join(stale_ids)}, details: {e}"
+            )
+    return {room_id: room_frames.get(room_id) for room_id in ids}
 
 
 def update_config():
@@ -78,16 +350,15 @@ def update_config():
 
 placeholder = st.empty()
 
-response = fetch_rooms()
-electricity_data = []
-if response:
-    id_list = [room["id"] for room in json.loads(response.text)["data"]]
-    name_list = [room["name"] for room in json.loads(response.text)["data"]]
-    table_name_list = [room["table_name"] for room in json.loads(response.text)["data"]]
-    group_list = [room["room_group"] for room in json.loads(response.text)["data"]]
-    unique_group_list = sorted(list(set(group_list)))
-    name2group = dict(zip(name_list, group_list))
-    name2id = dict(zip(name_list, id_list))
+start_stream_consumer()
+
+rooms = fetch_rooms()
+checked_names = []
+if rooms:
+    name_list = [room["name"] for room in rooms]
+    unique_group_list = sorted({room["room_group"] for room in rooms})
+    name2group = {room["name"]: room["room_group"] for room in rooms}
+    name2id = {room["name"]: room["id"] for room in rooms}
 else:
     st.error("An error occurred while trying to get data for the rooms, details: {e}")
     raise ValueError(
@@ -96,29 +367,35 @@ else:
 with st.sidebar:
     st.title("Room list 😘")
 
+    summary = fetch_summary()
     expanders = {}
     for group in unique_group_list:
         expanders[group] = st.expander(group, True)
     for name in name_list:
         # 本来想用 st.page_link 的，多好看，可惜有特性没进版，用不了，哎
-        if expanders[name2group[name]].checkbox(label=name):
-            response = fetch_room_electricity(name2id[name])
-            df = pd.DataFrame(
-                json.loads(response.text)["data"],
-            )
-            df["timestamp"] = pd.to_datetime(df["timestamp"], unit="s")
-            df.set_index("timestamp", inplace=True)
-            df_hourly = df.resample("h").mean().ffill()
-            # 添加房间标识列
-            df_hourly["room"] = name
-            electricity_data.append(df_hourly[["electricity", "room"]])
+        if expanders[name2group[name]].checkbox(
+            label=name, help=summary_help(summary.get(name2id[name]))
+        ):
+            checked_names.append(name)
+
+
+# 定时重跑图表部分，空闲时既不请求服务端也不重新计算
+@st.fragment(run_every=live_interval)
+def live_chart(names):
+    figure = None
+    if names:
+        rooms_frames = fetch_rooms_electricity(tuple(name2id[name] for name in names))
+        figure = chart_figure(rooms_frames, names)
+    if figure is not None:
+        st.plotly_chart(figure, use_container_width=True)
+    else:
+        st.write("Please select at least one room to display data 😭")
 
 
 with placeholder.container():
     st.title("Electricity Data 😎")
-    if electricity_data:
-        combined_df = pd.concat(electricity_data)
-        st.line_chart(combined_df, y="electricity", color="room")
+    live_chart(checked_names)
+    if checked_names:
         with st.expander("Hitokoto · 一言"):
             hitokoto_data_json = json.loads(get_hitokoto().text)
             st.write(f"『{hitokoto_data_json['hitokoto']}』")
@@ -130,5 +407,3 @@ with placeholder.container():
                 """,
                 unsafe_allow_html=True,
             )
-    else:
-        st.write("Please select at least one room to display data 😭")
@@ -1,29 +1,77 @@
 # Copyright © 2025 Illustar0.
 # All rights reserved.
+import argparse
+import bisect
+import hashlib
+import heapq
 import json
+import multiprocessing
+import os
+import queue
+import sqlite3
 import sys
 import time
+import threading
 import toml
 import httpx
 from pushx import Notifier
 from zzupy import ZZUPy
+from zzupy.exception import (
+    ZZUPyException,
+    LoginException,
+    ECardTokenException,
+    PermissionException,
+)
 from loguru import logger
 from http.cookies import SimpleCookie
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
 
 # 读取配置
 config = toml.load("worker.toml")
 usercode = config["accounts"]["usercode"]
 password = config["accounts"]["password"]
 interval = config["setting"]["interval"]
+# 每个房间的轮询间隔在 [minInterval, maxInterval] 之间自适应
+min_interval = config["setting"].get("minInterval", interval / 4)
+max_interval = config["setting"].get("maxInterval", interval * 4)
+# 在这个时间窗口内到期的房间合并到同一轮轮询
+schedule_window = config["setting"].get("scheduleWindow", 60)
 api_endpoint = config["setting"]["apiEndpoint"]
 apikey = config["setting"]["apiKey"]
-if "cookie"in config["accounts"]:
-    cookie = SimpleCookie().load(config["accounts"]["cookie"])
+if "cookie" in config["accounts"]:
+    cookie = SimpleCookie()
+    cookie.load(config["accounts"]["cookie"])
 else:
     cookie = None
+# 登录后刷新的 Cookie 保存在这里，下次启动优先使用
+cookie_file = config["accounts"].get("cookieFile", f"worker.{usercode}.cookie")
+relogin_backoff = config["setting"].get("reloginBackoff", 60)
+relogin_backoff_max = config["setting"].get("reloginBackoffMax", 3600)
+# 一轮全部失败时才推断登录失效，房间数少于该值（且少于配置的房间总数）的轮次不算，
+# 避免单独重试的失败房间反复触发重新登录
+auth_check_min_rooms = config["setting"].get("authCheckMinRooms", 3)
+
+request_rate = config["setting"].get("requestRate", 1 / 3)
+request_burst = config["setting"].get("requestBurst", 1)
+concurrency = config["setting"].get("concurrency", 4)
+
+outbox_path = config["setting"].get("outboxPath", "outbox.db")
+outbox_batch_size = config["setting"].get("outboxBatchSize", 5000)
+outbox_backoff = config["setting"].get("outboxBackoff", 5)
+outbox_backoff_max = config["setting"].get("outboxBackoffMax", 600)
 
 alarm_line = config["setting"]["alarmLine"]
 warning_line = config["setting"]["warningLine"]
+# 电量回升到阈值加上回差之后才解除告警，避免在阈值附近反复通知
+hysteresis = config["setting"].get("hysteresis", 1)
+push_workers = config["setting"].get("pushWorkers", 2)
+push_queue_size = config["setting"].get("pushQueueSize", 100)
+push_timeout = config["setting"].get("pushTimeout", 10)
+# 本地指标监听端口，0 为关闭，关闭时不记录任何指标
+metrics_port = config["setting"].get("metricsPort", 0)
+metrics_addr = config["setting"].get("metricsAddr", "127.0.0.1")
 
 pushes = [data for i, data in config["push"].items()]
 push_name_list = [pushes[i]["name"] for i in range(len(pushes))]
@@ -31,6 +79,14 @@ push_provider_list = [pushes[i]["provider"] for i in range(len(pushes))]
 push_params_list = [pushes[i]["params"] for i in range(len(pushes))]
 name2provider = dict(zip(push_name_list, push_provider_list))
 name2params = dict(zip(push_name_list, push_params_list))
+notifiers = {
+    name: Notifier(name2provider[name], **name2params[name]) for name in push_name_list
+}
+
+# 多账号分片，python worker.py supervise 时使用
+shards = config.get("shard", {})
+shard_replicas = config["setting"].get("shardReplicas", 64)
+shard_restart_delay = config["setting"].get("shardRestartDelay", 60)
 
 rooms = [data for i, data in config["room"].items()]
 room_id_list = [rooms[i]["id"] for i in range(len(rooms))]
@@ -48,44 +104,297 @@ logger.configure(
         }
     ]
 )
-logger.add(
-    "worker.log",
-    rotation="10 MB",
-    retention="7 days",
-    format="<green>{time:YYYY-MM-DD HH:mm:ss}</green> - <lvl>{level:^8}</> - <cyan>{name:^12}</cyan> : <cyan>{module:^7}</cyan> : <cyan>{line:^4}</cyan> - <lvl>{message}</>",
+
+
+def add_log_file(path):
+    logger.add(
+        path,
+        rotation="10 MB",
+        retention="7 days",
+        format="<green>{time:YYYY-MM-DD HH:mm:ss}</green> - <lvl>{level:^8}</> - <cyan>{name:^12}</cyan> : <cyan>{module:^7}</cyan> : <cyan>{line:^4}</cyan> - <lvl>{message}</>",
+    )
+
+
+# 分片子进程也会导入本模块，loguru 的轮转不能跨进程共享同一个文件，分片在 run_shard 中写各自的日志
+if multiprocessing.parent_process() is None:
+    add_log_file("worker.log")
+
+
+registry = metrics.Registry(False)
+cycle_latency = registry.histogram(
+    "onemonitor_worker_cycle_duration_seconds",
+    "Duration of an update cycle, from login to posting readings",
+)
+fetch_latency = registry.histogram(
+    "onemonitor_worker_fetch_duration_seconds", "Upstream eCard request latency"
+)
+room_fetch_latency = registry.gauge(
+    "onemonitor_worker_room_fetch_seconds",
+    "Latency of the last upstream request per room",
+    ("room",),
+)
+rate_limit_wait = registry.histogram(
+    "onemonitor_worker_rate_limit_wait_seconds",
+    "Time spent waiting for the request rate limiter",
+)
+api_post_latency = registry.histogram(
+    "onemonitor_worker_api_post_duration_seconds", "POST /readings latency"
+)
+notification_latency = registry.histogram(
+    "onemonitor_worker_notification_duration_seconds",
+    "Time to send a notification, capped by pushTimeout",
+    ("push",),
+)
+worker_errors = registry.counter(
+    "onemonitor_worker_errors_total",
+    "Errors by kind: login, fetch, post, push",
+    ("kind",),
 )
 
 
-# 更新房间的信息
-def update_room_info(room_id):
-    i = id2room_index.get(room_id)
-    data = {
-        "id": rooms[i]["id"],
-        "name": rooms[i]["name"],
-        "table_name": "room_" + rooms[i]["id"].replace("-", "_"),
-        "room_group": rooms[i]["group"],
-    }
+# 启动指标监听，分片进程各自使用配置中的端口
+def start_metrics(port):
+    if not port:
+        return
+    registry.enabled = True
+    metrics.serve(registry, metrics_addr, port)
+    logger.info(f"Serving metrics on http://{metrics_addr}:{port}/metrics")
+
+
+# 令牌桶，限制请求上游的速率
+class RateLimiter:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            # 令牌不足时先预支，按欠下的令牌数等待，保证并发请求依次放行
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+rate_limiter = RateLimiter(request_rate, request_burst)
+
+
+# 读取保存的 userToken，没有时退回到配置文件中的 Cookie
+def load_user_token(cookie_file, cookie=None):
+    if os.path.exists(cookie_file):
+        saved_cookie = SimpleCookie()
+        with open(cookie_file) as file:
+            saved_cookie.load(file.read())
+        if "userToken" in saved_cookie:
+            return saved_cookie["userToken"].value
+    if cookie is not None and "userToken" in cookie:
+        return cookie["userToken"].value
+    return None
+
+
+def save_user_token(cookie_file, user_token):
+    with open(cookie_file, "w") as file:
+        file.write(f"userToken={user_token}; Domain=.zzu.edu.cn; Path=/")
+
+
+# 跨轮次复用的 ZZUPy 登录会话，只在认证失败后才重新登录
+class Session:
+    def __init__(self, usercode, password, cookie=None, cookie_file=None):
+        self.usercode = usercode
+        self.password = password
+        self.cookie = cookie
+        self.cookie_file = cookie_file
+        self.me = None
+        self.login_count = 0
+        self.logged_in_at = None
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.me is None:
+                self.login()
+            return self.me
+
+    def age(self):
+        return 0 if self.logged_in_at is None else time.time() - self.logged_in_at
+
+    def login(self):
+        if self.failures:
+            delay = min(relogin_backoff * 2 ** (self.failures - 1), relogin_backoff_max)
+            logger.warning(f"Waiting {delay}s before logging in again")
+            time.sleep(delay)
+        user_token = load_user_token(self.cookie_file, self.cookie)
+        try:
+            me = self.new_client(user_token)
+            try:
+                me.login()
+            except ZZUPyException:
+                if user_token is None:
+                    raise
+                logger.warning("Saved cookie is no longer valid, login with password")
+                self.close_client(me)
+                me = self.new_client(None)
+                me.login()
+        except Exception:
+            self.failures += 1
+            raise
+        self.me = me
+        self.login_count += 1
+        self.logged_in_at = time.time()
+        self.failures = 0
+        user_token = me._client.cookies.get("userToken")
+        # 没有拿到 userToken 时不要把 "None" 写进 Cookie 文件
+        if user_token is not None:
+            save_user_token(self.cookie_file, user_token)
+        logger.info(f"Logged in, {self.login_count} logins since startup")
+
+    def new_client(self, user_token):
+        me = ZZUPy(self.usercode, self.password)
+        if user_token is not None:
+            # zzupy 3.0 会忽略构造函数传入的 Cookie，这里直接写入它的 HTTPX 客户端
+            me._client.cookies.set("userToken", user_token, ".zzu.edu.cn", "/")
+            me._userToken = user_token
+        return me
+
+    @staticmethod
+    def close_client(me):
+        # 停掉被丢弃会话的 eCard token 刷新定时器
+        timer = getattr(me.eCard, "_timer", None)
+        if timer is not None:
+            timer.cancel()
+        me._client.close()
+
+    # 认证失败时丢弃当前会话，下次 get() 会重新登录
+    def invalidate(self, me):
+        with self.lock:
+            if self.me is not me:
+                return
+            self.close_client(me)
+            self.me = None
+            self.failures += 1
+
+
+session = Session(usercode, password, cookie, cookie_file)
+
+
+# 后台发送通知，轮询流程只负责入队，不会被推送服务拖慢
+class NotificationDispatcher:
+    def __init__(self, workers, size, timeout):
+        self.queue = queue.Queue(maxsize=size)
+        self.timeout = timeout
+        for _ in range(workers):
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, push_name, title, content):
+        try:
+            self.queue.put_nowait((push_name, title, content))
+        except queue.Full:
+            logger.error(f"Notification queue is full, dropped: {title} {content}")
+
+    def run(self):
+        while True:
+            push_name, title, content = self.queue.get()
+            # 推送库没有超时参数，放到单独的线程里等待，超时后放弃
+            sender = threading.Thread(
+                target=self.send, args=(push_name, title, content), daemon=True
+            )
+            start = time.perf_counter()
+            sender.start()
+            sender.join(self.timeout)
+            notification_latency.observe(time.perf_counter() - start, push_name)
+            if sender.is_alive():
+                worker_errors.inc("push")
+                logger.error(f"Timed out sending notification via {push_name}")
+
+    @staticmethod
+    def send(push_name, title, content):
+        try:
+            notifiers[push_name].notify(title=title, content=content)
+            logger.info(f"Successfully sent notification via {push_name}")
+        except Exception as e:
+            worker_errors.inc("push")
+            logger.error(
+                f"An error occurred while sending notification via {push_name}, details: {e}"
+            )
+
+
+dispatcher = NotificationDispatcher(push_workers, push_queue_size, push_timeout)
+
+ALARM_TITLES = {1: "电费快要用完了", 2: "电费马上要用完啦！！！"}
+# 每个房间当前的告警级别：0 正常，1 警告，2 告警
+alarm_levels = {}
+
+
+def next_alarm_level(electricity, level):
+    if electricity < alarm_line or (
+        level >= 2 and electricity < alarm_line + hysteresis
+    ):
+        return 2
+    if electricity < warning_line or (
+        level >= 1 and electricity < warning_line + hysteresis
+    ):
+        return 1
+    return 0
+
+
+# 房间第一次由本进程检查时（启动、重启或分片重新分配），用服务端保存的上一次读数推算已有的告警级别，
+# 避免已经通知过的房间再次通知。查询失败时按正常处理，宁可重复通知也不漏报
+def initial_alarm_level(room_id):
     try:
-        response = httpx.put(
+        response = httpx.get(
             f"{api_endpoint}/rooms/{room_id}",
             headers={"Authorization": f"{apikey}"},
-            json=data,
+            params={"filter": "latest"},
         )
-        if response.status_code != 200:
-            logger.error(
-                f"Failed to update room information with id = {room_id}, API error"
-            )
         response_json = json.loads(response.text)
-        if response_json["status"] != "success":
-            logger.error(
-                f"Failed to update room information with id = {room_id}, API returns: {response_json['msg']}"
-            )
-        logger.info(f"Successfully updated room information with id = {room_id}")
+        if response.status_code != 200 or response_json["status"] != "success":
+            raise ValueError(response_json["msg"])
     except Exception as e:
-        logger.error(f"An error occurred in the PUT request, details: {e}")
+        logger.warning(
+            f"Failed to get the last electricity of room id = {room_id}, details: {e}"
+        )
+        return 0
+    level = 0
+    for row in response_json["data"]:
+        level = next_alarm_level(row["electricity"], level)
+    return level
+
+
+# 只在告警级别升高时通知一次
+def check_alarm(room, electricity):
+    if room["id"] not in alarm_levels:
+        alarm_levels[room["id"]] = initial_alarm_level(room["id"])
+    level = alarm_levels[room["id"]]
+    new_level = next_alarm_level(electricity, level)
+    alarm_levels[room["id"]] = new_level
+    if new_level > level:
+        dispatcher.submit(
+            room["pushName"],
+            ALARM_TITLES[new_level],
+            f"{room['name']} 剩余电费：{electricity}",
+        )
+
+
+# 本地配置中的房间对应的云端记录
+def room_payload(room):
+    return {
+        "id": room["id"],
+        "name": room["name"],
+        "table_name": "room_" + room["id"].replace("-", "_"),
+        "room_group": room["group"],
+    }
 
 
-# 与云端数据同步
+# 与云端数据同步：只拉取一次房间列表，比对后通过批量接口一次提交
 def sync_data_with_cloud():
     logger.info("Synchronize with cloud data")
     try:
@@ -104,151 +413,488 @@ def sync_data_with_cloud():
     except Exception as e:
         logger.error(f"An error occurred in the GET request, details: {e}")
         sys.exit()
-    response_rooms_data = json.loads(response.text)["data"]
-    remote_room_id_list = [
-        response_room_data["id"] for response_room_data in response_rooms_data
-    ]
-    # rooms_should_be_delete = list(set(remote_room_id_list) - set(room_id_list))
-    rooms_should_be_add = list(set(room_id_list) - set(remote_room_id_list))
-    """
-    if rooms_should_be_delete is not None:
-        for room_id in rooms_should_be_delete:
-            try:
-                response = httpx.delete(
-                    f"{api_endpoint}/rooms/{room_id}",
-                    headers={"Authorization": f"{apikey}"},
-                )
-                if response.status_code != 200:
-                    logger.error(
-                        f"An attempt to delete the room data with id = {room_id} failed, API error"
-                    )
-                    continue
-                response_json = json.loads(response.text)
-                if response_json["status"] != "success":
-                    logger.error(
-                        f"An attempt to delete the room data with id = {room_id} failed, API returns: {response_json["msg"]}"
-                    )
-                    continue
-                logger.info(
-                    f"Successfully deleted the room related data with id = {room_id}"
-                )
-            except Exception as e:
-                logger.error(f"An error occurred in the DELETE request, details: {e}")
-                continue
-    """
-    if rooms_should_be_add is not None:
-        for room_id in rooms_should_be_add:
-            i = id2room_index.get(room_id)
-            data = {
-                "id": rooms[i]["id"],
-                "name": rooms[i]["name"],
-                "table_name": "room_" + rooms[i]["id"].replace("-", "_"),
-                "room_group": rooms[i]["group"],
-            }
-            try:
-                response = httpx.post(
-                    f"{api_endpoint}/rooms",
-                    headers={"Authorization": f"{apikey}"},
-                    json=data,
-                )
-                if response.status_code != 200:
-                    logger.error(
-                        f"Failed to initialize room data with id = {room_id}, API error"
-                    )
-                    continue
-                response_json = json.loads(response.text)
-                if response_json["status"] != "success":
-                    logger.error(
-                        f"Failed to initialize room data with id = {room_id}, API returns: {response_json['msg']}"
-                    )
-                    continue
-                logger.info(f"Successfully initialized room data with id = {room_id}")
-            except Exception as e:
-                logger.error(f"An error occurred in the POST request, details: {e}")
-                continue
+    remote_rooms = {
+        response_room_data["id"]: response_room_data
+        for response_room_data in response_json["data"]
+    }
+    rooms_should_be_add = []
+    rooms_should_be_update = []
     for room in rooms:
-        # 偷个懒 (
-        try:
-            response = httpx.get(
-                f"{api_endpoint}/rooms", headers={"Authorization": f"{apikey}"}
+        data = room_payload(room)
+        remote = remote_rooms.get(room["id"])
+        if remote is None:
+            rooms_should_be_add.append(data)
+        elif any(remote.get(key) != value for key, value in data.items()):
+            rooms_should_be_update.append(data)
+    # 云端多出的房间不自动删除，以免误删历史读数
+    rooms_should_be_delete = set(remote_rooms) - set(room_id_list)
+    if rooms_should_be_delete:
+        logger.warning(
+            f"Rooms not in the local configuration are kept: {sorted(rooms_should_be_delete)}"
+        )
+    changed = rooms_should_be_add + rooms_should_be_update
+    if not changed:
+        logger.info("Synchronization with cloud data completed, nothing changed")
+        return
+    try:
+        response = httpx.put(
+            f"{api_endpoint}/rooms",
+            headers={"Authorization": f"{apikey}"},
+            json=changed,
+            timeout=60,
+        )
+        if response.status_code != 200:
+            logger.error(f"Failed to synchronize room data, API error")
+            return
+        response_json = json.loads(response.text)
+        if response_json["status"] != "success":
+            logger.error(
+                f"Failed to synchronize room data, API returns: {response_json['msg']}"
             )
-            if response.status_code != 200:
-                logger.error(f"Failed to obtain room data from the cloud, API error")
-                sys.exit()
-            response_json = json.loads(response.text)
-            if response_json["status"] != "success":
-                logger.error(
-                    f"Failed to obtain room data from the cloud, API returns: {response_json['msg']}"
-                )
-                sys.exit()
-        except Exception as e:
-            logger.error(f"An error occurred in the GET request, details: {e}")
-            sys.exit()
-        response_rooms_data = json.loads(response.text)["data"]
-        remote_room_id_list = [
-            response_room_data["id"] for response_room_data in response_rooms_data
-        ]
-        remote_rooms_index = remote_room_id_list.index(room["id"])
-        if (
-            response_rooms_data[remote_rooms_index]["name"] != room["name"]
-            or response_rooms_data[remote_rooms_index]["room_group"] != room["group"]
-        ):
-            update_room_info(room["id"])
-    logger.info("Synchronization with cloud data completed")
+            return
+    except Exception as e:
+        logger.error(f"An error occurred in the PUT request, details: {e}")
+        return
+    logger.info(
+        f"Synchronization with cloud data completed: {len(rooms_should_be_add)} added, {len(rooms_should_be_update)} updated"
+    )
+
+
+# 明确表示登录或校园卡 Token 失效的异常，其他 ZZUPy 异常（如默认房间）与会话无关
+AUTH_EXCEPTIONS = (
+    LoginException,
+    ECardTokenException,
+    PermissionException,
+    PermissionError,
+)
+
+
+# 获取房间电量，受全局速率限制
+def fetch_electricity(me, room_id):
+    start = time.perf_counter()
+    rate_limiter.acquire()
+    fetched = time.perf_counter()
+    rate_limit_wait.observe(fetched - start)
+    try:
+        return me.eCard.get_remaining_power(room_id)
+    finally:
+        latency = time.perf_counter() - fetched
+        fetch_latency.observe(latency)
+        room_fetch_latency.set(latency, room_id)
 
 
 # 更新电量 同时 通知
-def update_electricity(usercode, passwd, cookie = None):
-    me = ZZUPy(usercode, passwd, cookie)
-    me.login()
+def update_electricity(room_ids=None):
+    start = time.perf_counter()
+    try:
+        return update_rooms(room_id_list if room_ids is None else room_ids)
+    finally:
+        cycle_latency.observe(time.perf_counter() - start)
+
+
+def update_rooms(room_ids):
+    results = {}
+    try:
+        me = session.get()
+    except Exception as e:
+        worker_errors.inc("login")
+        logger.error(f"Failed to login, details: {e}")
+        return results
     timestamp = int(time.time())
-    for room_id in room_id_list:
-        time.sleep(3)
-        electricity = me.eCard.get_remaining_power(room_id)
-        if "pushName" in rooms[id2room_index[room_id]]:
-            if float(electricity) < alarm_line:
-                n = Notifier(
-                    name2provider[rooms[id2room_index[room_id]]["pushName"]],
-                    **name2params[rooms[id2room_index[room_id]]["pushName"]],
-                )
-                n.notify(
-                    title="电费马上要用完啦！！！",
-                    content=f"{rooms[id2room_index[room_id]]['name']} 剩余电费：{electricity}",
-                )
-            elif float(electricity) < warning_line:
-                n = Notifier(
-                    name2provider[rooms[id2room_index[room_id]]["pushName"]],
-                    **name2params[rooms[id2room_index[room_id]]["pushName"]],
-                )
-                n.notify(
-                    title="电费快要用完了",
-                    content=f"{rooms[id2room_index[room_id]]['name']} 剩余电费：{electricity}",
-                )
+    readings = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            room_id: executor.submit(fetch_electricity, me, room_id)
+            for room_id in room_ids
+        }
+    auth_failed = False
+    for room_id, future in futures.items():
         try:
-            response = httpx.post(
-                f"{api_endpoint}/rooms/{room_id}",
-                headers={"Authorization": f"{apikey}"},
-                json={"timestamp": timestamp, "electricity": float(electricity)},
+            electricity = future.result()
+        except Exception as e:
+            worker_errors.inc("fetch")
+            logger.error(
+                f"Failed to get the electricity of room id = {room_id}, details: {e}"
             )
-            if response.status_code != 200:
+            auth_failed = auth_failed or isinstance(e, AUTH_EXCEPTIONS)
+            continue
+        results[room_id] = float(electricity)
+        if "pushName" in rooms[id2room_index[room_id]]:
+            check_alarm(rooms[id2room_index[room_id]], float(electricity))
+        readings.append(
+            {
+                "room": room_id,
+                "data": [{"timestamp": timestamp, "electricity": float(electricity)}],
+            }
+        )
+    # 认证异常，或房间数足够多的一轮全部失败时，认为登录已失效
+    if auth_failed or (
+        room_ids
+        and len(room_ids) >= min(auth_check_min_rooms, len(room_id_list))
+        and not readings
+    ):
+        logger.warning("The session seems to be invalid, will login again")
+        session.invalidate(me)
+    logger.info(
+        f"Session age {int(session.age())}s, {session.login_count} logins since startup"
+    )
+    if readings:
+        failed = post_readings(readings)
+        if failed:
+            outbox.append(failed)
+    return results
+
+
+# 按房间各自的下次到期时间轮询：电量接近阈值或下降快的房间查得更勤，稳定的房间逐渐放缓
+class Scheduler:
+    def __init__(self, room_ids):
+        self.heap = []
+        # room_id -> 下次到期时间，与之不一致的堆元素已失效
+        self.due = {}
+        # room_id -> (上次读数时间, 上次电量, 当前间隔)
+        self.state = {}
+        self.set_rooms(room_ids)
+
+    def push(self, room_id, due):
+        self.due[room_id] = due
+        heapq.heappush(self.heap, (due, room_id))
+
+    # 分片模式下房间可能被重新分配，新加入的房间立即到期
+    def set_rooms(self, room_ids):
+        room_ids = set(room_ids)
+        for room_id in set(self.due) - room_ids:
+            del self.due[room_id]
+            self.state.pop(room_id, None)
+        now = time.time()
+        for room_id in sorted(room_ids - set(self.due)):
+            self.push(room_id, now)
+
+    def discard_stale(self):
+        while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+    def pop_due(self):
+        deadline = time.time() + schedule_window
+        room_ids = []
+        self.discard_stale()
+        while self.heap and self.heap[0][0] <= deadline:
+            room_id = heapq.heappop(self.heap)[1]
+            del self.due[room_id]
+            room_ids.append(room_id)
+            self.discard_stale()
+        return room_ids
+
+    def wait_time(self):
+        self.discard_stale()
+        return max(0, self.heap[0][0] - time.time()) if self.heap else interval
+
+    def next_interval(self, room_id, electricity, now):
+        if room_id not in self.state:
+            return interval
+        last_time, last_electricity, last_interval = self.state[room_id]
+        if electricity < alarm_line:
+            return min_interval
+        rate = (last_electricity - electricity) / max(now - last_time, 1)
+        if rate <= 0:
+            return last_interval * 2
+        # 预计越过下一条阈值前至少再查一次
+        target = warning_line if electricity >= warning_line else alarm_line
+        return min((electricity - target) / rate / 2, last_interval * 2)
+
+    def reschedule(self, room_ids, results):
+        now = time.time()
+        for room_id in room_ids:
+            if room_id not in results:
+                # 获取失败的房间尽快重试
+                self.push(room_id, now + min_interval)
+                continue
+            next_interval = min(
+                max(self.next_interval(room_id, results[room_id], now), min_interval),
+                max_interval,
+            )
+            self.state[room_id] = (now, results[room_id], next_interval)
+            self.push(room_id, now + next_interval)
+
+
+# 轮询主循环。get_room_ids 返回本进程负责的房间，分片模式下会随分配变化
+def run(get_room_ids=lambda: room_id_list):
+    threading.Thread(target=outbox.flush, daemon=True).start()
+    # 启动时补发上次未成功提交的读数
+    outbox.pending.set()
+    scheduler = Scheduler(get_room_ids())
+    while True:
+        scheduler.set_rooms(get_room_ids())
+        due_room_ids = scheduler.pop_due()
+        if due_room_ids:
+            scheduler.reschedule(due_room_ids, update_electricity(due_room_ids))
+            logger.info(f"This cycle ends, next cycle in {int(scheduler.wait_time())}s")
+        # 最长等待 scheduleWindow，以便及时发现房间的重新分配
+        time.sleep(min(scheduler.wait_time(), schedule_window))
+
+
+def hash_key(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+# 一致性哈希：分片增减时只有它负责的房间会迁移
+def assign_rooms(live_shards):
+    ring = sorted(
+        (hash_key(f"{name}#{replica}"), name)
+        for name in live_shards
+        for replica in range(shard_replicas)
+    )
+    ring_keys = [key for key, _ in ring]
+    explicit = {}
+    for name, shard in shards.items():
+        for room in shard.get("rooms", []):
+            explicit[config["room"][room]["id"] if room in config["room"] else room] = (
+                name
+            )
+    assignment = {name: [] for name in live_shards}
+    for room_id in room_id_list:
+        owner = explicit.get(room_id)
+        if owner not in assignment:
+            owner = ring[bisect.bisect(ring_keys, hash_key(room_id)) % len(ring)][1]
+        assignment[owner].append(room_id)
+    return assignment
+
+
+def shard_outbox_path(name):
+    root, ext = os.path.splitext(outbox_path)
+    return f"{root}.{name}{ext}"
+
+
+# 分片子进程：使用自己的账号、会话、速率限制和发件箱
+def run_shard(name, assignment):
+    global session, outbox, rate_limiter
+    shard = shards[name]
+    add_log_file(f"worker.{name}.log")
+    if "cookie" in shard:
+        shard_cookie = SimpleCookie()
+        shard_cookie.load(shard["cookie"])
+    else:
+        shard_cookie = None
+    session = Session(
+        shard["usercode"],
+        shard["password"],
+        shard_cookie,
+        shard.get("cookieFile", f"worker.{shard['usercode']}.cookie"),
+    )
+    outbox = Outbox(shard_outbox_path(name))
+    rate_limiter = RateLimiter(
+        shard.get("requestRate", request_rate),
+        shard.get("requestBurst", request_burst),
+    )
+    start_metrics(shard.get("metricsPort", 0))
+    logger.info(f"Shard {name} started")
+    run(lambda: assignment.get(name, []))
+
+
+def supervise():
+    if not shards:
+        logger.error(
+            "No [shard.*] section in worker.toml, supervise needs at least one"
+        )
+        sys.exit(1)
+    sync_data_with_cloud()
+    # spawn 启动的子进程不会继承父进程的线程和 SQLite 连接
+    context = multiprocessing.get_context("spawn")
+    manager = context.Manager()
+    assignment = manager.dict()
+    live_shards = set(shards)
+    processes = {}
+    restart_at = {}
+
+    def rebalance():
+        new_assignment = assign_rooms(sorted(live_shards))
+        for name in shards:
+            assignment[name] = new_assignment.get(name, [])
+        logger.info(
+            "Room assignment: "
+            + ", ".join(
+                f"{name}={len(room_ids)}" for name, room_ids in new_assignment.items()
+            )
+        )
+
+    def start(name):
+        processes[name] = context.Process(
+            target=run_shard, args=(name, assignment), name=f"shard-{name}"
+        )
+        processes[name].start()
+
+    rebalance()
+    for name in shards:
+        start(name)
+    while True:
+        time.sleep(5)
+        for name, process in processes.items():
+            if name in live_shards and not process.is_alive():
                 logger.error(
-                    f"Failed to add the electricity record with id = {room_id}, API error"
+                    f"Shard {name} exited with code {process.exitcode}, moving its rooms to other shards"
                 )
-                continue
-            response_json = json.loads(response.text)
-            if response_json["status"] != "success":
+                live_shards.discard(name)
+                restart_at[name] = time.time() + shard_restart_delay
+                if live_shards:
+                    rebalance()
+        for name in [name for name, at in restart_at.items() if at <= time.time()]:
+            del restart_at[name]
+            start(name)
+            live_shards.add(name)
+            rebalance()
+
+
+# 一次性提交本轮所有房间的电量，返回需要稍后重试的部分，全部成功时为空列表
+def post_readings(readings):
+    start = time.perf_counter()
+    failed = send_readings(readings)
+    api_post_latency.observe(time.perf_counter() - start)
+    if failed:
+        worker_errors.inc("post")
+    return failed
+
+
+# 约束错误（如房间不存在）重试也不会成功，直接丢弃；其余如数据库被锁定则需要重试
+def is_permanent_error(msg):
+    return "constraint failed" in msg
+
+
+def send_readings(readings):
+    failed = []
+    try:
+        response = httpx.post(
+            f"{api_endpoint}/readings",
+            headers={"Authorization": f"{apikey}"},
+            json=readings,
+        )
+        if response.status_code != 200:
+            logger.error(f"Failed to add the electricity records, API error")
+            return readings
+        response_json = json.loads(response.text)
+        if response_json["status"] != "success":
+            logger.error(
+                f"Failed to add the electricity records, API returns: {response_json['msg']}"
+            )
+            return readings
+        # 服务端按请求顺序逐个房间返回结果
+        for reading, result in zip(readings, response_json["data"]):
+            if result["status"] != "success":
                 logger.error(
-                    f"Failed to add the electricity record with id = {room_id}, API returns: {response_json['msg']}"
+                    f"Failed to add the electricity record with id = {result['room']}, API returns: {result['msg']}"
                 )
+                if not is_permanent_error(result["msg"]):
+                    failed.append(reading)
                 continue
-            logger.info(f"Successfully added the power data of room id = {room_id}")
-        except Exception as e:
-            logger.error(f"An error occurred in the POST request, details: {e}")
+            logger.info(
+                f"Successfully added the power data of room id = {result['room']}"
+            )
+    except Exception as e:
+        logger.error(f"An error occurred in the POST request, details: {e}")
+        return readings
+    return failed
+
+
+# 本地发件箱：提交失败的读数先落盘，API 恢复后由后台线程按时间顺序分批补发
+class Outbox:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS outbox(
+                room_id TEXT NOT NULL,
+                timestamp INT NOT NULL,
+                electricity REAL NOT NULL,
+                PRIMARY KEY (room_id, timestamp)
+            ) WITHOUT ROWID;"""
+        )
+        self.conn.commit()
+
+    def append(self, readings):
+        with self.lock:
+            self.conn.executemany(
+                """INSERT OR IGNORE INTO outbox VALUES (?, ?, ?);""",
+                [
+                    (reading["room"], data["timestamp"], data["electricity"])
+                    for reading in readings
+                    for data in reading["data"]
+                ],
+            )
+            self.conn.commit()
+        logger.warning(
+            f"Saved the electricity records of {len(readings)} rooms to outbox"
+        )
+        self.pending.set()
+
+    def peek(self, limit):
+        with self.lock:
+            return self.conn.execute(
+                """SELECT room_id, timestamp, electricity FROM outbox
+                   ORDER BY timestamp, room_id LIMIT ?;""",
+                (limit,),
+            ).fetchall()
+
+    def remove(self, rows):
+        with self.lock:
+            self.conn.executemany(
+                """DELETE FROM outbox WHERE room_id = ? AND timestamp = ?;""",
+                [(row[0], row[1]) for row in rows],
+            )
+            self.conn.commit()
+
+    # 服务端按 (room, timestamp) 去重，同一批重复补发不会产生重复数据
+    def flush(self):
+        backoff = 0
+        while True:
+            if backoff:
+                time.sleep(backoff)
+            else:
+                self.pending.wait()
+            self.pending.clear()
+            while True:
+                rows = self.peek(outbox_batch_size)
+                if not rows:
+                    backoff = 0
+                    break
+                readings = {}
+                for room_id, timestamp, electricity in rows:
+                    readings.setdefault(room_id, []).append(
+                        {"timestamp": timestamp, "electricity": electricity}
+                    )
+                failed = post_readings(
+                    [
+                        {"room": room_id, "data": data}
+                        for room_id, data in readings.items()
+                    ]
+                )
+                # 只移除已写入或永久失败的读数，需要重试的留在发件箱中
+                failed_rooms = {reading["room"] for reading in failed}
+                done = [row for row in rows if row[0] not in failed_rooms]
+                self.remove(done)
+                if done:
+                    logger.info(f"Replayed {len(done)} electricity records from outbox")
+                if failed:
+                    backoff = min(max(backoff * 2, outbox_backoff), outbox_backoff_max)
+                    logger.warning(
+                        f"Outbox replay failed for {len(failed_rooms)} rooms, retry in {backoff}s"
+                    )
+                    break
+
+
+outbox = Outbox(outbox_path)
 
 
 if __name__ == "__main__":
-    sync_data_with_cloud()
-    while True:
-        update_electricity(usercode, password, cookie)
-        logger.info("This cycle ends, waiting to enter the next cycle")
-        time.sleep(interval)
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=["supervise"],
+        help="supervise：按 [shard] 配置启动多个账号的分片进程",
+    )
+    args = parser.parse_args()
+    if args.command == "supervise":
+        supervise()
+    else:
+        start_metrics(metrics_port)
+        sync_data_with_cloud()
+        run()